@@ -6,34 +6,203 @@ http://nlp.stanford.edu/IR-book/html/htmledition/zipfs-law-modeling-the-distribu
 
 Ported to NLTK3 and Python 3 on May 23, 2016
 
+Words can be counted in parallel, reading files of any size in chunks (count_words()),
+approximately, with bounded memory (count_words_approximate()), or from a cached snapshot of the corpus (corpus_cache.py)
 '''
 
+import os
+import re
+import heapq
+import zlib
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
 from nltk.corpus import gutenberg
-from nltk import FreqDist
 from matplotlib import pyplot
+import corpus_cache
+import bounded_pool
 
-# Load a book and compute word distribution
-words = gutenberg.words('austen-emma.txt')
-fdist = FreqDist(words)
+# the same tokens of WordPunctTokenizer, used by gutenberg.words()
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]+")
 
-# create a list containing the counts of each word in the distribution
-# fdist.most_common() considers items in decreasing order of frequency
-count_list = [count for (word,count) in list(fdist.most_common()) if word.isalpha()]   
 
-# plot the Zipf's Law with linear scales
-pyplot.plot(list(range(len(count_list))), count_list)
-pyplot.xlabel('rank')
-pyplot.ylabel('freq')
-pyplot.show()
+def iter_chunks(paths, chunk_size=1 << 22, encoding='utf-8'):
+    '''
+    Generator: reads the files in chunks of about chunk_size characters;
+    a chunk always ends with a whitespace, so that no token is split between two chunks
+    '''
+    for path in paths:
+        with open(path, 'r', encoding=encoding, errors='replace') as text_file:
+            rest = ''
+            while True:
+                chunk = text_file.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = rest + chunk
+                split = max(chunk.rfind(' '), chunk.rfind('\n'), chunk.rfind('\t'))
+                if split < 0:  # no whitespace at all: wait for more text
+                    rest = chunk
+                    continue
+                rest = chunk[split + 1:]
+                yield chunk[:split + 1]
+            if rest:
+                yield rest
 
-input("Press Enter to continue...")
 
-# plot the Zipf's Law with logarithmic scales
-pyplot.plot(list(range(len(count_list))), count_list)
-pyplot.xlabel('log_10(rank)')
-pyplot.ylabel('log_10(freq)')
-pyplot.xscale('log')
-pyplot.yscale('log')
-pyplot.show()
+def _count_chunk(chunk):
+    ''' Worker process: counts the tokens of a chunk of text '''
+    return Counter(TOKEN_PATTERN.findall(chunk))
 
 
+def count_words(paths, processes=None, chunk_size=1 << 22, encoding='utf-8'):
+    ''' Counts the tokens of the files: chunks of text are counted by a pool of processes, then counts are merged '''
+    total = Counter()
+    with Pool(processes) as pool:
+        for counts in bounded_pool.imap_bounded(pool, _count_chunk, iter_chunks(paths, chunk_size, encoding),
+                                                2 * (processes or os.cpu_count())):
+            total.update(counts)
+    return total
+
+
+class CountMinSketch:
+    '''
+    Count-min sketch (see: https://en.wikipedia.org/wiki/Count%E2%80%93min_sketch): approximate counts of any
+    number of tokens in a fixed amount of memory (depth x width counters); counts are never underestimated.
+    Sketches with the same width and depth can be summed
+    '''
+    def __init__(self, width=1 << 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _columns(self, token):
+        return sketch_columns(token, self.width, self.depth)
+
+    def add(self, token, count=1):
+        for row, column in enumerate(self._columns(token)):
+            self.table[row, column] += count
+
+    def add_columns(self, columns, counts):
+        ''' Adds counts[i] to the counters columns[:, i] (see sketch_columns()), e.g., the update of a chunk of text '''
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], counts)   # the same column may occur more than once
+
+    def __getitem__(self, token):
+        return int(min(self.table[row, column] for row, column in enumerate(self._columns(token))))
+
+    def merge(self, other):
+        self.table += other.table
+
+
+def sketch_columns(token, width, depth):
+    ''' The columns of the counters of a token, one for each row of a sketch '''
+    data = token.encode('utf-8')
+    # crc32 with a different starting value for each row: the same columns in every process
+    return [zlib.crc32(data, row + 1) % width for row in range(depth)]
+
+
+def _sketch_chunk(job):
+    '''
+    Worker process: the update of a sketch with the counts of a chunk of text, as (columns, counts) (see
+    CountMinSketch.add_columns()), plus the k most frequent tokens of the chunk (the candidates): only the counters
+    of the tokens of the chunk are sent back, not a whole sketch
+    '''
+    chunk, k, width, depth = job
+    counts = _count_chunk(chunk)
+    columns = np.array([sketch_columns(token, width, depth) for token in counts], dtype=np.int64).reshape(-1, depth)
+    return (columns.T, np.fromiter(counts.values(), dtype=np.int64, count=len(counts)),
+            [token for (token, count) in counts.most_common(k)], sum(counts.values()))
+
+
+def count_words_approximate(paths, k=10000, width=1 << 20, depth=4, processes=None, chunk_size=1 << 22,
+                            encoding='utf-8'):
+    '''
+    Approximate counts of the k most frequent tokens (heavy hitters), in bounded memory: each chunk of text is
+    counted by a pool of processes, and its counts are added to a single sketch. A token frequent in the whole text
+    is frequent in some chunk: the k most frequent tokens of each chunk are the candidates, and only the best k are
+    kept.
+    Returns the list of (token, estimated count), in decreasing order of count, and the total number of tokens
+    '''
+    sketch = CountMinSketch(width, depth)
+    candidates = set()
+    n_tokens = 0
+    with Pool(processes) as pool:
+        jobs = ((chunk, k, width, depth) for chunk in iter_chunks(paths, chunk_size, encoding))
+        for columns, counts, chunk_candidates, chunk_tokens in bounded_pool.imap_bounded(
+                pool, _sketch_chunk, jobs, 2 * (processes or os.cpu_count())):
+            sketch.add_columns(columns, counts)
+            n_tokens += chunk_tokens
+            candidates.update(chunk_candidates)
+            if len(candidates) > 2 * k:  # keep the memory bounded
+                candidates = set(heapq.nlargest(k, candidates, key=sketch.__getitem__))
+    heavy_hitters = heapq.nlargest(k, ((sketch[token], token) for token in candidates))
+    return [(token, count) for (count, token) in heavy_hitters], n_tokens
+
+
+def log_binned(counts, bins_per_decade=10):
+    '''
+    Aggregates the counts (in decreasing order: counts[0] is the count of rank 1) in bins of logarithmically
+    increasing width; returns the geometric center rank of each bin and the average count of its words
+    '''
+    ranks = np.arange(1, len(counts) + 1)
+    n_bins = max(1, int(np.ceil(np.log10(len(counts) + 1) * bins_per_decade)))
+    edges = np.unique(np.logspace(0, np.log10(len(counts) + 1), n_bins + 1).astype(np.int64))
+    bin_ids = np.searchsorted(edges, ranks, side='right') - 1
+    words_in_bin = np.bincount(bin_ids)
+    used = words_in_bin > 0
+    mean_counts = np.bincount(bin_ids, weights=counts)[used] / words_in_bin[used]
+    center_ranks = np.exp(np.bincount(bin_ids, weights=np.log(ranks))[used] / words_in_bin[used])
+    return center_ranks, mean_counts
+
+
+def fit_zipf(ranks, counts):
+    ''' Fits freq = C / rank^s on a log-log scale; returns (s, C) '''
+    slope, intercept = np.polyfit(np.log10(ranks), np.log10(counts), 1)
+    return -slope, 10 ** intercept
+
+
+def plot_zipf(count_list):
+    ''' Plots the Zipf's Law with linear and logarithmic scales, with log-binned ranks and the fitted exponent '''
+    counts = np.array(count_list, dtype=np.float64)
+    ranks, mean_counts = log_binned(counts)
+    s, c = fit_zipf(ranks, mean_counts)
+    print("Zipf exponent s = %.3f (freq = %.1f / rank^s)" % (s, c))
+
+    # plot the Zipf's Law with linear scales
+    pyplot.plot(ranks, mean_counts, 'o-')
+    pyplot.xlabel('rank')
+    pyplot.ylabel('freq')
+    pyplot.show()
+
+    input("Press Enter to continue...")
+
+    # plot the Zipf's Law with logarithmic scales
+    pyplot.plot(ranks, mean_counts, 'o', label='log-binned counts')
+    pyplot.plot(ranks, c / ranks ** s, label='fit: s = %.3f' % s)
+    pyplot.xlabel('log_10(rank)')
+    pyplot.ylabel('log_10(freq)')
+    pyplot.xscale('log')
+    pyplot.yscale('log')
+    pyplot.legend()
+    pyplot.show()
+
+
+def main(approximate=False, cached=True):
+    # Load a book and compute word distribution
+    paths = [gutenberg.abspath('austen-emma.txt')]
+    if approximate:
+        word_counts, n_tokens = count_words_approximate(paths, encoding='latin1')
+    elif cached:
+        # the book is tokenized once, then words are counted on the token ids of its snapshot
+        word_counts = corpus_cache.gutenberg('austen-emma.txt').word_counts().most_common()
+    else:
+        word_counts = count_words(paths, encoding='latin1').most_common()
+
+    # create a list containing the counts of each word in the distribution
+    # most_common() considers items in decreasing order of frequency
+    count_list = [count for (word, count) in word_counts if word.isalpha()]
+    plot_zipf(count_list)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,37 +4,155 @@ Created on May 19, 2014
 @author: roberto
 
 A simple HMM POS tagger, trained on the Brown corpus; "closed vocabulary" assumption
+(or "open vocabulary", guessing the tags of unknown words from their suffixes and shapes; see train_unknown_words())
 
 Ported to Python 3 and NLTK 3 on May 5, 2016
 '''
 
 import re                         # for regular expressions
+import os
+import json
+import time
+import atexit
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
 from nltk.corpus import brown
-from nltk.tag.hmm import HiddenMarkovModelTrainer
-from nltk.probability import SimpleGoodTuringProbDist
-from nltk import ConfusionMatrix
+from nltk.tag.hmm import HiddenMarkovModelTrainer, HiddenMarkovModelTagger
+from nltk.probability import SimpleGoodTuringProbDist, LidstoneProbDist
+from nltk.probability import FreqDist, ConditionalFreqDist, ConditionalProbDist
+import instrumentation
+import corpus_cache
+import bounded_pool
 
 
-def load_corpus():
-    """Load tagged corpus, and clean words and tags"""
+# Dense log-probability tables of a trained HMM (log base 2, as in NLTK), indexed by tag id and word id.
+# initial[i] = log P(tag_i at start), transition[i, j] = log P(tag_j | tag_i), emission[i, k] = log P(word_k | tag_i);
+# the last column of 'emission' is the log-probability that the smoothing assigns to a word never seen in training.
+# Optionally (open vocabulary, see train_unknown_words()) the emission scores of unknown words are estimated from
+# their suffixes and shapes: suffix_index and shape_index map suffixes and shapes to rows of suffix_logprob and shape_logprob
+HMMTables = namedtuple('HMMTables', ['tags', 'word_index', 'initial', 'transition', 'emission',
+                                     'suffix_index', 'suffix_logprob', 'shape_index', 'shape_logprob'],
+                       defaults=[None, None, None, None])
+
+_UNSEEN_WORD = object()   # a sample that no FreqDist has ever seen
+
+MODEL_FORMAT_VERSION = 2   # version 2: optional unknown word model
+
+
+# modifiers removed from tags: -NC=citations, -HL=word in headline, -TL=word in title
+TAG_MODIFIERS = re.compile("-NC|-HL|-TL")
+
+
+def clean_tag(tag):
+    """Remove modifiers '-NC', '-HL', '-TL' from a tag"""
+    return TAG_MODIFIERS.sub("", tag)
+
+
+def clean_sentence(tagged_sentence):
+    """Lower-case the words of a tagged sentence and remove modifiers '-NC', '-HL', '-TL' from tags"""
+    return [(word.lower(), clean_tag(tag)) for (word, tag) in tagged_sentence]
+
+
+def iter_corpus(categories='news', chunk_size=1000, cache_dir=None):
+    """
+    Generator: yields the cleaned tagged sentences of the corpus in chunks (lists of at most chunk_size sentences).
+    The corpus is read lazily, so memory does not grow with its size; e.g., train on the whole Brown corpus with:
+        train(itertools.chain.from_iterable(iter_corpus(categories=None)), word_types, tag_set)
+    With a cache_dir, sentences are read from a snapshot of the corpus (see corpus_cache.py), built on the first run
+    """
+    if cache_dir is None:
+        tagged_sentences = map(clean_sentence, brown.tagged_sents(categories=categories))
+    else:
+        # the snapshot cleans each distinct word and tag once
+        tagged_sentences = corpus_cache.brown(categories, cache_dir).tagged_sents(str.lower, clean_tag)
+    chunk = []
+    for tagged_sentence in tagged_sentences:
+        chunk.append(tagged_sentence)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _clean_file(fileid):
+    """Worker process: the cleaned tagged sentences of a single file of the corpus"""
+    return [clean_sentence(tagged_sentence) for tagged_sentence in brown.tagged_sents(fileids=fileid)]
+
+
+def _file_vocabulary(fileid):
+    """Worker process: the sets of words and tags of a single file of the corpus"""
+    word_types = set()
+    tag_set = set()
+    for tagged_sentence in _clean_file(fileid):
+        for word, tag in tagged_sentence:
+            word_types.add(word)
+            tag_set.add(tag)
+    return word_types, tag_set
+
+
+def iter_corpus_parallel(categories='news', processes=None):
+    """
+    Same as iter_corpus(), but the files of the corpus are cleaned in parallel by a pool of processes;
+    yields one chunk per file, in the order of the corpus. At most 2 files per process are in flight (being
+    cleaned, or cleaned and waiting to be consumed), so memory does not grow with the size of the corpus
+    """
+    with Pool(processes) as pool:
+        yield from bounded_pool.imap_bounded(pool, _clean_file, brown.fileids(categories=categories),
+                                             2 * (processes or os.cpu_count()))
+
+
+def corpus_vocabulary(categories='news', processes=None):
+    """Sets of words and tags of the corpus; files are read in parallel, and only vocabularies are kept in memory"""
+    word_types = set()
+    tag_set = set()
+    with Pool(processes) as pool:
+        for file_word_types, file_tag_set in pool.imap_unordered(_file_vocabulary, brown.fileids(categories=categories)):
+            word_types |= file_word_types
+            tag_set |= file_tag_set
+    return word_types, tag_set
+
+
+@instrumentation.instrumented('tagger.load_corpus')
+def load_corpus(categories='news', processes=1, cache_dir=None):
+    """
+    Load tagged corpus, and clean words and tags.
+    With processes > 1 (or None: as many as CPUs) files are cleaned in parallel.
+    With a cache_dir, the tagged sentences are a lazy sequence over the memory-mapped snapshot of the corpus
+    (see corpus_cache.py): a sentence is built only when it is read, so the corpus is never all in memory;
+    processes is ignored
+    """
     # the tagged corpus, divided by sentences
     # e.g., [[('the','DET-NC'),('equation','N-NC'),...,('.','.')],[("in","P-TL"),("addition","N-TL"),...,('.','.')],...]
-    fully_tagged_sentences = brown.tagged_sents(categories='news')
+    if cache_dir is not None:
+        snapshot = corpus_cache.brown(categories, cache_dir)
+        tagged_sentences = snapshot.tagged_sents(str.lower, clean_tag)
+        # the words and the tags of the corpus are the (cleaned) vocabulary and tag set of the snapshot
+        word_types = set(map(str.lower, snapshot.vocabulary))
+        tag_set = set(map(clean_tag, snapshot.tagset))
+        instrumentation.count('tagger.load_corpus.sentences', len(tagged_sentences))
+        return tagged_sentences, word_types, tag_set
+
+    if processes == 1:
+        chunks = iter_corpus(categories)
+    else:
+        chunks = iter_corpus_parallel(categories, processes)
 
     tagged_sentences = []
     tag_set = set()
     word_types = set()
 
-    for tagged_sentence in fully_tagged_sentences:
-        #remove modifiers '-NC', '-HL', '-TL' from tags
-        tagged_sentence = [(word.lower(),re.sub("-NC|-HL|-TL","",tag)) for (word,tag) in tagged_sentence]
-        tagged_sentences += [tagged_sentence]  # add tagged sentence to the list
+    for chunk in chunks:
+        tagged_sentences.extend(chunk)  # add the cleaned tagged sentences to the list
 
         # add each word and the corresponding tag to the respective sets
-        for word,tag in tagged_sentence:
-            word_types.add(word)   # it's a set: do not add duplicates
-            tag_set.add(tag)       # it's a set: do not add duplicates
+        for tagged_sentence in chunk:
+            for word, tag in tagged_sentence:
+                word_types.add(word)   # it's a set: do not add duplicates
+                tag_set.add(tag)       # it's a set: do not add duplicates
 
+    instrumentation.count('tagger.load_corpus.sentences', len(tagged_sentences))
     return tagged_sentences, word_types, tag_set
 
 
@@ -46,29 +164,492 @@ def split_corpus(tagged_sentences, train_set_fraction):
     return train_set, test_set
 
 
-def train(train_set, word_types, tag_set):
+@instrumentation.instrumented('tagger.estimator.good_turing')
+def good_turing(fd, bins):
+    """GoodTuring smoothing"""
+    # see: https://nltk.googlecode.com/svn/trunk/doc/api/nltk.probability.SimpleGoodTuringProbDist-class.html
+    return SimpleGoodTuringProbDist(fd, bins)
+
+
+@instrumentation.instrumented('tagger.estimator.lidstone')
+def lidstone(fd, bins, gamma=0.1):
+    """Lidstone (additive) smoothing"""
+    # see: http://en.wikipedia.org/wiki/Additive_smoothing
+    return LidstoneProbDist(fd, gamma, bins)
+
+
+def train(train_set, word_types, tag_set, estimator=good_turing):
     """
     Training...
     Called this way, the HMM knows the whole set of tags and the whole set of words (no "unknown" word and/or tag during test)
     """
     trainer = HiddenMarkovModelTrainer(list(tag_set), list(word_types)) # tag_set and word_types are sets: I need to create lists
-    # GoodTuring smoothing
-    # see: https://nltk.googlecode.com/svn/trunk/doc/api/nltk.probability.SimpleGoodTuringProbDist-class.html
-    #      http://en.wikipedia.org/wiki/Additive_smoothing
-    hmm = trainer.train_supervised(train_set, estimator=lambda fd, bins: SimpleGoodTuringProbDist(fd, bins))
+    hmm = trainer.train_supervised(train_set, estimator=estimator)
     return hmm
 
 
-def test(hmm, test_set):
-    """testing with a list of tagged sentences..."""
-    hmm.test(test_set, verbose=False)
+# tag and word ids, set once in each worker process by _init_counter()
+_tag_index = None
+_word_index = None
+
+
+def _init_counter(tag_index, word_index):
+    global _tag_index, _word_index
+    _tag_index = tag_index
+    _word_index = word_index
+
+
+def _count_shard(shard):
+    """
+    Worker process: counts starting tags, tag transitions and (tag, word) emissions in a shard of the train set.
+    Returns integer arrays: starting[tag], transitions[from_tag * n_tags + to_tag],
+    and the sparse emission counts as (tag * n_words + word) keys with their counts
+    """
+    n_tags = len(_tag_index)
+    n_words = len(_word_index)
+    tag_ids = []
+    word_ids = []
+    sentence_starts = []
+    for tagged_sentence in shard:
+        if tagged_sentence:
+            sentence_starts.append(len(tag_ids))
+        for word, tag in tagged_sentence:
+            tag_ids.append(_tag_index[tag])
+            word_ids.append(_word_index[word])
+    tag_ids = np.array(tag_ids, dtype=np.int64)
+    word_ids = np.array(word_ids, dtype=np.int64)
+    is_start = np.zeros(len(tag_ids), dtype=bool)
+    is_start[sentence_starts] = True
+
+    starting = np.bincount(tag_ids[is_start], minlength=n_tags)
+    follows = ~is_start[1:]   # a transition reaches each token that does not start a sentence
+    transitions = np.bincount(tag_ids[:-1][follows] * n_tags + tag_ids[1:][follows], minlength=n_tags * n_tags)
+    emission_keys, emission_counts = np.unique(tag_ids * n_words + word_ids, return_counts=True)
+    return starting, transitions, emission_keys, emission_counts
+
+
+def train_parallel(train_set, word_types, tag_set, estimator=good_turing, processes=None):
+    """
+    Same as train(), but the train set is split among a pool of processes that count
+    transitions and emissions; counts are then summed and smoothed as HiddenMarkovModelTrainer does
+    """
+    states = list(tag_set)
+    symbols = list(word_types)
+    tag_index = {tag: i for i, tag in enumerate(states)}
+    word_index = {word: i for i, word in enumerate(symbols)}
+    n_tags = len(states)
+    n_words = len(symbols)
+
+    # one contiguous shard for each process
+    processes = processes or os.cpu_count()
+    shard_size = max(1, -(-len(train_set) // processes))   # rounded up; an empty train set has no shard
+    shards = [list(train_set[i:i + shard_size]) for i in range(0, len(train_set), shard_size)]  # lists: picklable
+
+    starting = np.zeros(n_tags, dtype=np.int64)
+    transitions = np.zeros(n_tags * n_tags, dtype=np.int64)
+    emission_keys = [np.zeros(0, dtype=np.int64)]
+    emission_counts = [np.zeros(0, dtype=np.int64)]
+    with Pool(processes, initializer=_init_counter, initargs=(tag_index, word_index)) as pool:
+        for shard_counts in pool.imap_unordered(_count_shard, shards):
+            starting += shard_counts[0]
+            transitions += shard_counts[1]
+            emission_keys.append(shard_counts[2])
+            emission_counts.append(shard_counts[3])
+    emission_keys, key_ids = np.unique(np.concatenate(emission_keys), return_inverse=True)
+    emissions = np.zeros(len(emission_keys), dtype=np.int64)
+    np.add.at(emissions, key_ids, np.concatenate(emission_counts))
+
+    # from counts to frequency distributions, then smoothing (see HiddenMarkovModelTrainer.train_supervised)
+    starting_fd = FreqDist({states[i]: count for i, count in enumerate(starting.tolist()) if count})
+    transitions_cfd = ConditionalFreqDist()
+    for key in np.flatnonzero(transitions).tolist():
+        transitions_cfd[states[key // n_tags]][states[key % n_tags]] = int(transitions[key])
+    outputs_cfd = ConditionalFreqDist()
+    for key, count in zip(emission_keys.tolist(), emissions.tolist()):
+        outputs_cfd[states[key // n_words]][symbols[key % n_words]] = count
+
+    pi = estimator(starting_fd, n_tags)
+    A = ConditionalProbDist(transitions_cfd, estimator, n_tags)
+    B = ConditionalProbDist(outputs_cfd, estimator, n_words)
+    return HiddenMarkovModelTagger(symbols, states, A, B, pi)
+
+
+def timed_decoder(tagger, name='tagger.decode'):
+    """A tagger (a function from a list of words to their tags) that times each sentence, if instrumentation is on"""
+    def timed_tagger(words):
+        with instrumentation.timer(name, words=len(words)):
+            return tagger(words)
+    return timed_tagger
+
+
+class TagEvaluation:
+    """
+    Evaluation of a tagger: gold and estimated tags are encoded as integer ids, sentence by sentence (so that the
+    tags can be streamed from any decoder); accuracy, precision, recall, F1 and the confusion matrix are then computed
+    from a single np.bincount() of the pairs (gold id, estimated id)
+    """
+    def __init__(self, tags=()):
+        self.tags = list(tags)   # tag ids are positions in this list; unknown tags are added when first seen
+        self.tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        self._gold = []          # arrays of tag ids, one for each sentence
+        self._estimated = []
+        self._matrix = None      # the confusion matrix, computed when needed
+
+    def _encode(self, tags):
+        tag_index = self.tag_index
+        for tag in tags:
+            if tag not in tag_index:
+                tag_index[tag] = len(self.tags)
+                self.tags.append(tag)
+        return np.fromiter((tag_index[tag] for tag in tags), dtype=np.int32, count=len(tags))
+
+    def add(self, gold_tags, estimated_tags):
+        """Add the gold and the estimated tags of a sentence"""
+        if len(gold_tags) != len(estimated_tags):
+            raise ValueError("%d gold tags but %d estimated tags" % (len(gold_tags), len(estimated_tags)))
+        self._gold.append(self._encode(gold_tags))
+        self._estimated.append(self._encode(estimated_tags))
+        self._matrix = None
+
+    def confusion_matrix(self):
+        """matrix[i, j] = how many times gold tag tags[i] was estimated as tags[j]"""
+        if self._matrix is None:
+            n_tags = len(self.tags)
+            gold = np.concatenate(self._gold) if self._gold else np.zeros(0, dtype=np.int32)
+            estimated = np.concatenate(self._estimated) if self._estimated else np.zeros(0, dtype=np.int32)
+            pairs = gold.astype(np.int64) * n_tags + estimated
+            self._matrix = np.bincount(pairs, minlength=n_tags * n_tags).reshape(n_tags, n_tags)
+        return self._matrix
+
+    def n_tokens(self):
+        return int(self.confusion_matrix().sum())
+
+    def accuracy(self):
+        matrix = self.confusion_matrix()
+        return np.trace(matrix) / matrix.sum() if matrix.sum() else 0.0
+
+    def precision_recall_f1(self):
+        """Per-tag precision, recall, F1 and support (number of gold tokens): arrays indexed by tag id"""
+        matrix = self.confusion_matrix()
+        correct = np.diag(matrix).astype(np.float64)
+        estimated = matrix.sum(axis=0)
+        support = matrix.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(estimated > 0, correct / estimated, 0.0)
+            recall = np.where(support > 0, correct / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+        return precision, recall, f1, support
+
+    def report(self, max_tags=20):
+        """Print accuracy, and precision, recall and F1 of the max_tags most frequent gold tags (all if None)"""
+        print("accuracy over %d tokens: %.2f" % (self.n_tokens(), self.accuracy() * 100))
+        precision, recall, f1, support = self.precision_recall_f1()
+        print("%-10s %9s %9s %9s %9s" % ("tag", "precision", "recall", "F1", "support"))
+        for i in np.argsort(-support, kind='stable')[:max_tags]:
+            if support[i]:
+                print("%-10s %9.4f %9.4f %9.4f %9d" % (self.tags[i], precision[i], recall[i], f1[i], support[i]))
+
+    def format_confusion_matrix(self):
+        """The confusion matrix of the tags that occur, as text: rows are gold tags, columns are estimated tags"""
+        matrix = self.confusion_matrix()
+        used = np.flatnonzero(matrix.sum(axis=0) + matrix.sum(axis=1))
+        used = used[np.argsort([self.tags[i] for i in used], kind='stable')]
+        labels = [str(self.tags[i]) for i in used]
+        label_width = max([len(label) for label in labels] + [1])
+        width = max([len(label) for label in labels] + [len(str(matrix.max())) + 2 if matrix.size else 1])
+        lines = [" " * label_width + " | " + " ".join(label.rjust(width) for label in labels) + " |",
+                 "-" * (label_width + 1) + "+" + "-" * ((width + 1) * len(labels) + 1) + "+"]
+        for i, label in zip(used, labels):
+            cells = []
+            for j in used:
+                cell = str(matrix[i, j]) if matrix[i, j] else "."
+                cells.append(("<%s>" % cell if i == j else cell).rjust(width))
+            lines.append(label.rjust(label_width) + " | " + " ".join(cells) + " |")
+        lines.append(lines[1])
+        lines.append("(row = gold; col = estimated)")
+        return "\n".join(lines)
+
+
+def evaluate(test_set, tag_sequences, tags=()):
+    """
+    Evaluate the tag sequences estimated for the sentences of the test set; tag_sequences can be any iterable
+    (e.g., a generator that decodes one sentence at a time), consumed along with the test set: there must be
+    exactly one tag sequence for each sentence
+    """
+    evaluation = TagEvaluation(tags)
+    tag_sequences = iter(tag_sequences)
+    n_sentences = 0
+    for tagged_sentence in test_set:
+        estimated_tags = next(tag_sequences, None)
+        if estimated_tags is None:
+            raise ValueError("%d tag sequences for a test set of more sentences" % n_sentences)
+        evaluation.add([tag for (word, tag) in tagged_sentence], estimated_tags)
+        n_sentences += 1
+    if next(tag_sequences, None) is not None:
+        raise ValueError("more tag sequences than the %d sentences of the test set" % n_sentences)
+    return evaluation
+
+
+def test(hmm, test_set, tables=None):
+    """
+    testing with a list of tagged sentences...
+    The sentences are decoded with the compiled tables of the HMM (see compile_tables()), if given, or with NLTK
+    """
+    if tables is not None:
+        sentences = [[word for (word, tag) in tagged_sentence] for tagged_sentence in test_set]
+        with instrumentation.timer('tagger.decode_all', sentences=len(sentences)):
+            tag_sequences = tag_sentences(tables, sentences)
+        evaluate(test_set, tag_sequences, tables.tags).report()
+    else:
+        best_path = timed_decoder(hmm.best_path)
+        tag_sequences = (best_path([word for (word, tag) in tagged_sentence]) for tagged_sentence in test_set)
+        evaluate(test_set, tag_sequences, hmm._states).report()
+    print()
+
+
+def compile_tables(hmm):
+    """Export the probabilities of a trained HMM into dense NumPy arrays, for fast decoding"""
+    # NLTK caches the very same float32 tables used by best_path(): reusing them gives identical results
+    hmm._create_cache()
+    initial, emission, transition, word_index = hmm._cache
+    tags = list(hmm._states)
+    # smoothing assigns the same probability to every unseen word, so a single extra column is enough
+    unseen = np.array([hmm._outputs[tag].logprob(_UNSEEN_WORD) for tag in tags], np.float32)
+    emission = np.hstack([emission, unseen[:, np.newaxis]])
+    return HMMTables(tags, dict(word_index), initial.copy(), transition.copy(), emission)
+
+
+def word_shape(word):
+    """The shape of a word: letters become 'x' (or 'X'), digits 'd', runs are collapsed; e.g., '1960's' --> 'd'x'"""
+    shape = []
+    for char in word:
+        if char.isdigit():
+            char = 'd'
+        elif char.isalpha():
+            char = 'X' if char.isupper() else 'x'
+        if not shape or shape[-1] != char:
+            shape.append(char)
+    return ''.join(shape)
+
+
+def train_unknown_words(train_set, tags, rare_threshold=10, max_suffix_length=5):
+    """
+    Train the unknown word model (as in the TnT tagger, see: http://www.aclweb.org/anthology/A00-1031):
+    tags of unknown words behave like those of rare words (seen at most rare_threshold times in the train set), so
+    P(tag | suffix) and P(tag | shape) are estimated on rare words, and the emission score of an unknown word is
+        log P(tag | suffix) + log P(tag | shape) - 2 log P(tag)
+    i.e., proportional to P(word | tag), assuming suffix and shape are independent.
+    Every suffix of length 1..max_suffix_length is smoothed with its one character shorter suffix:
+        P(tag | suffix) = (P_ML(tag | suffix) + theta * P(tag | shorter suffix)) / (1 + theta)
+    The scores are precomputed: tagging an unknown word only needs len(word) lookups.
+    Returns the fields of HMMTables for the unknown word model
+    """
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+    word_counts = FreqDist(word for tagged_sentence in train_set for (word, tag) in tagged_sentence)
+
+    # tag counts for each suffix and each shape of rare words ('' is the empty suffix, i.e., all rare words);
+    # '' is always in the model, even without rare words (then all tags are equally likely for unknown words)
+    suffix_counts = {'': np.zeros(len(tags))}
+    shape_counts = {}
+    for tagged_sentence in train_set:
+        for word, tag in tagged_sentence:
+            if word_counts[word] > rare_threshold:
+                continue
+            for length in range(min(max_suffix_length, len(word)) + 1):
+                suffix = word[len(word) - length:]
+                suffix_counts.setdefault(suffix, np.zeros(len(tags)))[tag_index[tag]] += 1
+            shape_counts.setdefault(word_shape(word), np.zeros(len(tags)))[tag_index[tag]] += 1
+    tag_counts = suffix_counts['']
+    tag_probs = (tag_counts + 0.5) / (tag_counts.sum() + 0.5 * len(tags))   # no tag has zero probability
+    theta = tag_probs.std(ddof=1) if len(tags) > 1 else 0.0
+
+    # suffixes sorted by length: each suffix is smoothed with an already smoothed shorter suffix
+    suffixes = sorted(suffix_counts, key=len)
+    suffix_probs = {'': tag_probs}
+    for suffix in suffixes[1:]:
+        counts = suffix_counts[suffix]
+        suffix_probs[suffix] = (counts / counts.sum() + theta * suffix_probs[suffix[1:]]) / (1 + theta)
+    shapes = [''] + sorted(shape_counts)    # '' (no shape information) has a zero score
+    shape_probs = [tag_probs] + [(shape_counts[shape] / shape_counts[shape].sum() + theta * tag_probs) / (1 + theta)
+                                 for shape in shapes[1:]]
+
+    log_tag_probs = np.log2(tag_probs)
+    return {'suffix_index': {suffix: i for i, suffix in enumerate(suffixes)},
+            'suffix_logprob': np.array([np.log2(suffix_probs[suffix]) - log_tag_probs for suffix in suffixes],
+                                       dtype=np.float32),
+            'shape_index': {shape: i for i, shape in enumerate(shapes)},
+            'shape_logprob': np.array([np.log2(probs) - log_tag_probs for probs in shape_probs], dtype=np.float32)}
+
+
+def unknown_word_emission(tables, word):
+    """Emission scores (one for each tag) of a word that is not in the vocabulary"""
+    if tables.suffix_index is None or not len(tables.suffix_logprob):
+        # "closed vocabulary" (or an empty unknown word model): all unseen words are the same
+        return tables.emission[:, -1]
+    # walk the suffixes from the shortest to the longest one: if a suffix is not in the index, longer ones are not either
+    row = 0
+    for length in range(1, len(word) + 1):
+        suffix_row = tables.suffix_index.get(word[len(word) - length:])
+        if suffix_row is None:
+            break
+        row = suffix_row
+    shape_row = tables.shape_index.get(word_shape(word), 0)
+    return tables.suffix_logprob[row] + tables.shape_logprob[shape_row]
+
+
+@instrumentation.instrumented('tagger.viterbi_batch')
+def viterbi_batch(tables, sentences):
+    """
+    Viterbi decoding of a batch of sentences (lists of words) at once; returns a list of tag sequences.
+    Sentences are padded to the same length: a mask freezes the scores of the sentences already finished
+    """
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.intp)
+    batch = len(sentences)
+    max_len = int(lengths.max()) if batch else 0
+    if max_len == 0:
+        return [[] for sentence in sentences]
+
+    # word ids, padded with the "unseen word" id (the padding is never used)
+    unknown_id = tables.emission.shape[1] - 1
+    word_ids = np.full((batch, max_len), unknown_id, dtype=np.intp)
+    for b, sentence in enumerate(sentences):
+        word_ids[b, :len(sentence)] = [tables.word_index.get(word, unknown_id) for word in sentence]
+    emissions = tables.emission.T[word_ids]   # (batch, max_len, n_tags)
+    if tables.suffix_index is not None:
+        # open vocabulary: emission scores of unknown words from their suffixes and shapes
+        unknown_emissions = {}
+        for b, t in zip(*np.nonzero(word_ids == unknown_id)):
+            if t < lengths[b]:
+                word = sentences[b][t]
+                if word not in unknown_emissions:
+                    unknown_emissions[word] = unknown_word_emission(tables, word)
+                emissions[b, t] = unknown_emissions[word]
+
+    # max-plus recurrence in log space: scores[b, j] = max_i(scores[b, i] + transition[i, j]) + emission[j, w_t]
+    rows = np.arange(batch)
+    scores = tables.initial + emissions[:, 0]
+    backpointers = np.zeros((max_len, batch, len(tables.tags)), dtype=np.intp)
+    for t in range(1, max_len):
+        candidates = scores[:, :, np.newaxis] + tables.transition   # (batch, from tag, to tag)
+        best = candidates.argmax(axis=1)                            # first maximum, as np.argmax in NLTK
+        new_scores = np.take_along_axis(candidates, best[:, np.newaxis, :], axis=1)[:, 0, :] + emissions[:, t]
+        scores = np.where((t < lengths)[:, np.newaxis], new_scores, scores)
+        backpointers[t] = best
+
+    # follow the back pointers, each sentence starting from its own last word
+    paths = np.empty((batch, max_len), dtype=np.intp)
+    current = scores.argmax(axis=1)
+    for t in range(max_len - 1, 0, -1):
+        paths[:, t] = current
+        current = np.where(t < lengths, backpointers[t, rows, current], current)
+    paths[:, 0] = current
+
+    return [[tables.tags[i] for i in paths[b, :lengths[b]]] for b in range(batch)]
+
+
+def tag_sentences(tables, sentences, batch_size=64):
+    """Decode many sentences with viterbi_batch(); sentences of similar length are batched together"""
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))  # less padding
+    tag_sequences = [None] * len(sentences)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        for i, tags in zip(batch, viterbi_batch(tables, [sentences[i] for i in batch])):
+            tag_sequences[i] = tags
+    return tag_sequences
+
+
+def compare_decoders(hmm, tables, test_set):
+    """Decode the test set with NLTK best_path() and with the compiled tables; check results and speed"""
+    sentences = [[word for (word, tag) in tagged_sentence] for tagged_sentence in test_set]
+
+    start = time.perf_counter()
+    best_path = timed_decoder(hmm.best_path)
+    nltk_tags = [best_path(sentence) for sentence in sentences]
+    nltk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    numpy_tags = tag_sentences(tables, sentences)
+    numpy_time = time.perf_counter() - start
+
+    mismatches = sum(1 for (tags1, tags2) in zip(nltk_tags, numpy_tags) if list(tags1) != tags2)
+    print("NLTK best_path : %10.1f sentences/s" % (len(sentences) / nltk_time))
+    print("NumPy Viterbi  : %10.1f sentences/s" % (len(sentences) / numpy_time))
+    print("Sentences tagged differently: %d\n" % mismatches)
+
+
+def accuracy_by_vocabulary(tables, test_set):
+    """Tag the test set and print the accuracy on all tokens, on known tokens and on unknown (out of vocabulary) tokens"""
+    tag_sequences = tag_sentences(tables, [[word for (word, tag) in tagged_sentence] for tagged_sentence in test_set])
+    correct = {True: 0, False: 0}   # known: True/False
+    total = {True: 0, False: 0}
+    for tagged_sentence, estimated_tags in zip(test_set, tag_sequences):
+        for (word, gold_tag), estimated_tag in zip(tagged_sentence, estimated_tags):
+            known = word in tables.word_index
+            total[known] += 1
+            correct[known] += gold_tag == estimated_tag
+    for label, tokens in (("all", [True, False]), ("known", [True]), ("unknown", [False])):
+        n_total = sum(total[known] for known in tokens)
+        n_correct = sum(correct[known] for known in tokens)
+        print("Accuracy (%-7s tokens): %6.2f%% of %d" % (label, n_correct / n_total * 100 if n_total else 0.0, n_total))
     print()
 
 
-def example(hmm, test_set, n1, n2):
-    """Try to tag sentences between n1 and n2 (excluded) of the test set; just to show the result..."""
-    estimated_tags = []
-    gold_tags = []
+def save_model(tables, model_path):
+    """
+    Save the compiled tables to the directory model_path: a JSON header (format version, tags, words,
+    suffixes and shapes of the unknown word model) and one .npy file for each log-probability table
+    """
+    os.makedirs(model_path, exist_ok=True)
+    words = _sorted_keys(tables.word_index)
+    arrays = {field: getattr(tables, field) for field in HMMTables._fields
+              if isinstance(getattr(tables, field), np.ndarray)}
+    for name, array in arrays.items():
+        np.save(os.path.join(model_path, name + '.npy'), np.ascontiguousarray(array))
+    header = {'format_version': MODEL_FORMAT_VERSION,
+              'tags': list(tables.tags),
+              'words': words,
+              'suffixes': _sorted_keys(tables.suffix_index),
+              'shapes': _sorted_keys(tables.shape_index),
+              'arrays': {name: {'dtype': str(array.dtype), 'shape': list(array.shape)}
+                         for name, array in arrays.items()}}
+    # the header is written last: a directory without it is an incomplete model
+    with open(os.path.join(model_path, 'header.json'), 'w', encoding='utf-8') as header_file:
+        json.dump(header, header_file)
+
+
+def load_model(model_path):
+    """
+    Load the tables saved by save_model(). Arrays are memory-mapped (read only): loading is almost instantaneous,
+    and all the processes using the same model share the same memory pages
+    """
+    with open(os.path.join(model_path, 'header.json'), encoding='utf-8') as header_file:
+        header = json.load(header_file)
+    if header['format_version'] not in (1, MODEL_FORMAT_VERSION):
+        raise ValueError("Unsupported model format version %s in %s" % (header['format_version'], model_path))
+    arrays = {}
+    for name, description in header['arrays'].items():
+        arrays[name] = np.load(os.path.join(model_path, name + '.npy'), mmap_mode='r')
+        if list(arrays[name].shape) != description['shape']:
+            raise ValueError("Corrupted model: unexpected shape of %s in %s" % (name, model_path))
+    word_index = {word: word_id for word_id, word in enumerate(header['words'])}
+    if header.get('suffixes') is not None:
+        arrays['suffix_index'] = {suffix: i for i, suffix in enumerate(header['suffixes'])}
+        arrays['shape_index'] = {shape: i for i, shape in enumerate(header['shapes'])}
+    return HMMTables(header['tags'], word_index, **arrays)
+
+
+def _sorted_keys(index):
+    """The keys of a {key: id} dictionary, sorted by id (None if there is no dictionary)"""
+    return None if index is None else sorted(index, key=index.get)
+
+
+def example(tagger, test_set, n1, n2):
+    """
+    Try to tag sentences between n1 and n2 (excluded) of the test set; just to show the result...
+    tagger: a function that, given a list of words, returns the list of their tags (e.g., hmm.best_path)
+    """
+    tagger = timed_decoder(tagger)
+    evaluation = TagEvaluation()
     for test_sentence in test_set[n1:n2]:
 
         # the zip() function with the "*" operator can be used to unzip the list
@@ -77,7 +658,7 @@ def example(hmm, test_set, n1, n2):
         unlabelled_test_sentence, test_sentence_tags = zip(*test_sentence)
 
         # decoding...
-        test_sentence_estimated_tags = hmm.best_path(unlabelled_test_sentence)
+        test_sentence_estimated_tags = tagger(unlabelled_test_sentence)
 
         # [("this","PP"),("is","VB")] --> "this/PP is/VB"
         print("Test: %s" % ' '.join([word+"/"+tag for (word,tag) in test_sentence]))
@@ -93,23 +674,52 @@ def example(hmm, test_set, n1, n2):
         print("Comparation:", comparation_list)
         print("Accuracy   : %.2f\n" % (sum(comparation_list) / len(test_sentence) * 100))  # --> sum([1, 1, 0]) / 3 = 2/3
 
-        estimated_tags += test_sentence_estimated_tags  # collects estimated tags, for further use
-        gold_tags += test_sentence_tags                 # collects correct tags, for further use
+        evaluation.add(test_sentence_tags, test_sentence_estimated_tags)  # collects gold and estimated tags
 
     # prints confusion matrix
-    print(ConfusionMatrix(gold_tags,estimated_tags))
+    print(evaluation.format_confusion_matrix())
 
 
 def main():
     train_set_fraction = 0.8  # 80 %
     n1 = 0        # for the example: tag sentences i: n1 <= i < n2
     n2 = 10
-    
-    tagged_sentences, words, tag_set = load_corpus()
+    model_path = 'brown_news_hmm'  # where the trained model is saved
+    open_vocabulary = False  # if True, the HMM only knows the words of the train set
+    instrument = False  # if True, time the hot paths: the trace is written to 'hmm_trace.jsonl', the profile to 'hmm.pstats'
+
+    if instrument:
+        instrumentation.enable(trace_path='hmm_trace.jsonl', profile=True)
+        atexit.register(instrumentation.finish, 'hmm.pstats')  # report at the end, whatever path main() takes
+
+    tagged_sentences, words, tag_set = load_corpus(cache_dir=corpus_cache.DEFAULT_CACHE_DIR)  # parsed once, then cached
     train_set, test_set = split_corpus(tagged_sentences, train_set_fraction)
+
+    if os.path.exists(os.path.join(model_path, 'header.json')):
+        # a model has already been trained: no need to train it again (unless it was trained for the other
+        # vocabulary assumption: only open vocabulary models have an unknown word model)
+        tables = load_model(model_path)
+        if (tables.suffix_index is not None) == open_vocabulary:
+            accuracy_by_vocabulary(tables, test_set)
+            example(lambda sentence: viterbi_batch(tables, [sentence])[0], test_set, n1, n2)
+            return
+        print("The model in %s was trained with open_vocabulary=%s: training it again\n" % (model_path,
+                                                                                           not open_vocabulary))
+
+    if open_vocabulary:
+        words = set([word for tagged_sentence in train_set for (word, tag) in tagged_sentence])
     hmm = train(train_set, words, tag_set)
-    test(hmm, test_set)
-    example(hmm, test_set, n1, n2)
+    tables = compile_tables(hmm)
+    if open_vocabulary:
+        tables = tables._replace(**train_unknown_words(train_set, tables.tags))
+    save_model(tables, model_path)
+    if open_vocabulary:
+        accuracy_by_vocabulary(tables, test_set)
+        example(lambda sentence: viterbi_batch(tables, [sentence])[0], test_set, n1, n2)
+    else:
+        test(hmm, test_set, tables)
+        compare_decoders(hmm, tables, test_set)
+        example(hmm.best_path, test_set, n1, n2)
 
 
 if __name__ == '__main__':
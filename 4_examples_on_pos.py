@@ -8,40 +8,137 @@ Some examples with the complete and simplified tag set used by NLTK
 Ported to Python 3 and NLTK 3 on May 5, 2016
 '''
 
+import os
+from collections import Counter
+import numpy as np
 import nltk
+from nltk.probability import ConditionalFreqDist
 
-# prints the first 10 sentences of the Brown corpus, with their original tags, and
-# wth the simplified tag set
-print("---Regular Brown tagset:", nltk.corpus.brown.tagged_words()[1:10])
+# -NC=citations, -HL=word in headline, -TL=word in title
+TAG_MODIFIERS = ("-NC", "-HL", "-TL")
 
-input("Press Enter to continue...")
 
-# Extracts and prints the complete Brown estimated_tags (remove '' and modifiers '-NC', '-HL', '-TL' from tags)
-# -NC=citations, -HL=word in headline, -TL=word in title
-print("---Cleaned Brown tagset:")
-brown_corpus_tags = sorted(set([t for (w,t) in nltk.corpus.brown.tagged_words()]))
-cleaned_brown_corpus_tags =  [t for t in brown_corpus_tags if t != '' and "-NC" not in t and "-HL" not in t and "-TL" not in t]
-print(cleaned_brown_corpus_tags)
-
-input("Press Enter to continue...")
-
-# Print help for each Brown tag
-print("---Meaning of Brown corpus tags:")
-for t in cleaned_brown_corpus_tags:
-    print("\tTAG:", t)
-    print("\tDescription:\n", nltk.help.brown_tagset(t), "\n")
-
-input("Press Enter to continue...")
-
-# Print most ambiguous words (i.e., words with several POS's) in the 'news' section 
-# of the Brown corpus
-print("---Most ambiguous words:")
-brown_news_tagged = nltk.corpus.brown.tagged_words(categories='news')
-# data = p(tag | word)
-data = nltk.ConditionalFreqDist([(word.lower(), tag) for (word, tag) in brown_news_tagged])
-# E.g., data['open'] = {'ADJ': 13, 'V': 11, 'N': 8, 'ADV': 1}, i.e., p(tag | 'open')
-#       data['open'].keys() = ['ADJ', 'V', 'N', 'ADV']
-for word in data.conditions():  # i.e., the set of words
-    if (len(data[word]) > 3):  # print words with more than 3 tags
-        estimated_tags = data[word].keys()
-        print(word, "-",' '.join(estimated_tags))
+class TagIndex:
+    '''
+    How many times each (lower-cased) word has each tag, in each category of the Brown corpus; built with a single
+    pass over the corpus, and stored by columns: row i says that word words[word[i]] has tag tags[tag[i]]
+    count[i] times in category categories[category[i]]
+    '''
+    def __init__(self, categories, words, tags, category, word, tag, count):
+        self.categories = list(categories)
+        self.words = list(words)
+        self.tags = list(tags)
+        self.category = category
+        self.word = word
+        self.tag = tag
+        self.count = count
+
+    @classmethod
+    def build(cls, corpus=nltk.corpus.brown):
+        ''' Reads each file of the corpus once '''
+        categories, words, tags = {}, {}, {}  # string --> id, in order of appearance
+        counts = Counter()
+        for fileid in corpus.fileids():
+            category_id = categories.setdefault(corpus.categories(fileid)[0], len(categories))
+            for word, tag in corpus.tagged_words(fileids=[fileid]):
+                word_id = words.setdefault(word.lower(), len(words))
+                tag_id = tags.setdefault(tag, len(tags))
+                counts[category_id, word_id, tag_id] += 1
+        rows = np.array(sorted(counts), dtype=np.int64).reshape(-1, 3)
+        return cls(categories, words, tags,
+                   rows[:, 0].astype(np.uint8), rows[:, 1].astype(np.uint32), rows[:, 2].astype(np.uint16),
+                   np.array([counts[key] for key in sorted(counts)], dtype=np.uint32))
+
+    @classmethod
+    def cached(cls, index_path, corpus=nltk.corpus.brown):
+        ''' Loads the index from index_path, or builds it (and saves it) if missing '''
+        if os.path.exists(index_path):
+            return cls.load(index_path)
+        index = cls.build(corpus)
+        index.save(index_path)
+        return index
+
+    def save(self, index_path):
+        np.savez_compressed(index_path, categories=np.array(self.categories), words=np.array(self.words),
+                            tags=np.array(self.tags), category=self.category, word=self.word, tag=self.tag,
+                            count=self.count)
+
+    @classmethod
+    def load(cls, index_path):
+        with np.load(index_path, allow_pickle=False) as data:
+            return cls(data['categories'].tolist(), data['words'].tolist(), data['tags'].tolist(),
+                       data['category'], data['word'], data['tag'], data['count'])
+
+    def _rows(self, category):
+        ''' Selects the rows of a category (all the rows if category is None) '''
+        if category is None:
+            return np.ones(len(self.count), dtype=bool)
+        return self.category == self.categories.index(category)
+
+    def cleaned_tags(self):
+        ''' The sorted tag set, without '' and the tags with modifiers '-NC', '-HL', '-TL' '''
+        return sorted(t for t in self.tags if t != '' and not any(modifier in t for modifier in TAG_MODIFIERS))
+
+    def ambiguous_words(self, k, category=None):
+        ''' Words with more than k tags in the category (in the whole corpus if None): {word: [tags]} '''
+        rows = self._rows(category)
+        word_tag = np.unique(self.word[rows].astype(np.int64) * len(self.tags) + self.tag[rows])  # (word, tag) pairs
+        n_tags = np.bincount(word_tag // len(self.tags), minlength=len(self.words))
+        ambiguous = {}
+        for pair in word_tag[n_tags[word_tag // len(self.tags)] > k].tolist():
+            word_id, tag_id = divmod(pair, len(self.tags))
+            ambiguous.setdefault(self.words[word_id], []).append(self.tags[tag_id])
+        return ambiguous
+
+    def emission_counts(self, category=None, strip_modifiers=True):
+        '''
+        ConditionalFreqDist: how many times each tag is assigned to each word, e.g., to seed the emission tables of an
+        HMM tagger; tags can be cleaned as load_corpus() in the HMM tagger does
+        '''
+        cleaned = list(self.tags)
+        if strip_modifiers:
+            for modifier in TAG_MODIFIERS:
+                cleaned = [tag.replace(modifier, "") for tag in cleaned]
+        cfd = ConditionalFreqDist()
+        rows = self._rows(category)
+        for word_id, tag_id, count in zip(self.word[rows].tolist(), self.tag[rows].tolist(), self.count[rows].tolist()):
+            cfd[cleaned[tag_id]][self.words[word_id]] += count
+        return cfd
+
+
+def main():
+    index_path = 'brown_tag_index.npz'  # the index is computed once, and saved here
+
+    # prints the first 10 sentences of the Brown corpus, with their original tags, and
+    # wth the simplified tag set
+    print("---Regular Brown tagset:", nltk.corpus.brown.tagged_words()[1:10])
+
+    input("Press Enter to continue...")
+
+    # Extracts and prints the complete Brown estimated_tags (remove '' and modifiers '-NC', '-HL', '-TL' from tags)
+    # -NC=citations, -HL=word in headline, -TL=word in title
+    print("---Cleaned Brown tagset:")
+    index = TagIndex.cached(index_path)
+    cleaned_brown_corpus_tags = index.cleaned_tags()
+    print(cleaned_brown_corpus_tags)
+
+    input("Press Enter to continue...")
+
+    # Print help for each Brown tag
+    print("---Meaning of Brown corpus tags:")
+    for t in cleaned_brown_corpus_tags:
+        print("\tTAG:", t)
+        print("\tDescription:\n", nltk.help.brown_tagset(t), "\n")
+
+    input("Press Enter to continue...")
+
+    # Print most ambiguous words (i.e., words with several POS's) in the 'news' section
+    # of the Brown corpus
+    # E.g., in the 'news' section the word 'open' has tags {'ADJ': 13, 'V': 11, 'N': 8, 'ADV': 1}
+    print("---Most ambiguous words:")
+    for word, estimated_tags in index.ambiguous_words(3, category='news').items():  # words with more than 3 tags
+        print(word, "-", ' '.join(estimated_tags))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,46 +5,294 @@ Created on May 30, 2014
 A simple example of parsing with a CFG and a PCFG, both learned from the Penn treebank
 Ported to Python3 on May 5, 2016
 """
-from nltk.corpus import treebank
-from nltk.grammar import Nonterminal, induce_pcfg
-from nltk.grammar import CFG
-from nltk.parse import EarleyChartParser
+import os
+import math
+import time
+import pickle
+import signal
+import heapq
+import itertools
+import atexit
+from multiprocessing import Pool
+from collections import namedtuple, Counter
+import numpy as np
+from nltk.grammar import Nonterminal, ProbabilisticProduction
+from nltk.grammar import CFG, PCFG
+from nltk.parse import EarleyChartParser, ChartParser
 from nltk.parse.pchart import InsideChartParser
+from nltk.parse.chart import LeafEdge
+from nltk.tree import Tree, ProbabilisticTree
+import instrumentation
+import corpus_cache
+import bounded_pool
 
 
-def generate_grammar_and_parsers(parsed_sents):
-    # From sentences, extract the parsing tree and transform each tree to a list of CFG productions;
-    # generate a set containing all the productions (without repetitions)
-    tbank_productions_with_repet = [production for parsed_sent in parsed_sents for production in parsed_sent.productions()]
-    tbank_productions = set(tbank_productions_with_repet)  # exclude repetitions
-    print("Num. of unique productions read:", len(tbank_productions))
+# A PCFG in Chomsky normal form, encoded with integer arrays (log-probabilities are in base 2, as in NLTK):
+# - symbols: list of nonterminals (symbol ids are positions in this list); start: id of the start symbol
+# - intermediate: boolean array, True for the symbols introduced by the binarization
+# - lexical: {word: (array of symbol ids, array of log-probabilities)} for the productions A -> 'word'
+# - binary_parent, binary_left, binary_right, binary_logprob: productions A -> B C
+# - unary_parent, unary_child, unary_logprob: unary closure, i.e., best chains A -> ... -> C, sorted by parent
+# - unary_next: {(A, C): B}, the first step B of the best chain A -> B -> ... -> C
+CompiledPCFG = namedtuple('CompiledPCFG', ['symbols', 'start', 'intermediate', 'lexical',
+                                           'binary_parent', 'binary_left', 'binary_right', 'binary_logprob',
+                                           'unary_parent', 'unary_child', 'unary_logprob', 'unary_next'])
+
+
+def count_productions(parsed_sents):
+    '''
+    Count the CFG productions of the parse trees, in a single pass over the trees (that can be streamed).
+    Productions are interned: each one is stored once, and counted by its id.
+    Returns the list of the (unique) productions and the list of their counts
+    '''
+    production_ids = {}  # production --> id
+    productions = []
+    counts = Counter()   # id --> count
+    for parsed_sent in parsed_sents:
+        for production in parsed_sent.productions():
+            production_id = production_ids.get(production)
+            if production_id is None:
+                production_id = production_ids[production] = len(productions)
+                productions.append(production)
+            counts[production_id] += 1
+    return productions, [counts[production_id] for production_id in range(len(productions))]
+
+
+def load_production_counts(n1, n2, cache_dir='grammar_cache'):
+    '''
+    The productions (and their counts) of the treebank parsed sentences i, with n1 <= i < n2.
+    They are computed once and then cached on disk, in cache_dir
+    '''
+    cache_path = os.path.join(cache_dir, "treebank_productions_%d_%d.pickle" % (n1, n2))
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    production_counts = count_productions(corpus_cache.treebank().parsed_sents()[n1:n2])  # trees are read lazily
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path + '.tmp', 'wb') as cache_file:
+        pickle.dump(production_counts, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + '.tmp', cache_path)  # no half-written cache, if interrupted
+    return production_counts
+
+
+def induce_grammars(productions, counts, start=Nonterminal('S')):
+    '''
+    Build a CFG and a PCFG from the productions and their counts; as induce_pcfg() does, the probability of
+    a production A -> B C is count(A -> B C) / count(A)
+    '''
+    cfg_grammar = CFG(start, productions)
+    lhs_counts = Counter()
+    for production, count in zip(productions, counts):
+        lhs_counts[production.lhs()] += count
+    pcfg_grammar = PCFG(start, [ProbabilisticProduction(production.lhs(), production.rhs(),
+                                                        prob=count / lhs_counts[production.lhs()])
+                                for production, count in zip(productions, counts)])
+    return cfg_grammar, pcfg_grammar
+
+
+class InstrumentedInsideChartParser(InsideChartParser):
+    '''
+    InsideChartParser that, if instrumentation is on, times each sentence and counts the edges inserted in the queue,
+    popped from it (i.e., added to the chart) and pruned. parse() sorts the queue before popping each edge: the
+    change of the queue length between two sorts is the number of edges inserted, minus the one popped
+    '''
+    def parse(self, tokens):
+        self._queue_length = 0
+        with instrumentation.timer('parser.inside_chart.parse', words=len(tokens)):
+            return super().parse(tokens)
+
+    def sort_queue(self, queue, chart):
+        if instrumentation.enabled():
+            instrumentation.count('parser.inside_chart.edges_inserted', len(queue) - self._queue_length)
+            instrumentation.count('parser.inside_chart.edges_popped')
+            self._queue_length = len(queue) - 1  # an edge is popped right after sorting (and pruning)
+        super().sort_queue(queue, chart)
+
+    def _prune(self, queue, chart):
+        queue_length = len(queue)
+        super()._prune(queue, chart)
+        if instrumentation.enabled():
+            instrumentation.count('parser.inside_chart.edges_pruned', queue_length - len(queue))
+            self._queue_length -= queue_length - len(queue)
+
+
+def generate_grammar_and_parsers(n1, n2, cache_dir='grammar_cache'):
+    # From sentences i of the treebank (n1 <= i < n2), extract the parsing tree and transform each tree to a list of
+    # CFG productions; count how many times each production occurs (counts are cached in cache_dir)
+    productions, counts = load_production_counts(n1, n2, cache_dir)
+    print("Num. of unique productions read:", len(productions))
+
+    # Build a CFG and a PCFG from the productions (the PCFG needs the counts!)
+    cfg_grammar, pcfg_grammar = induce_grammars(productions, counts)
 
-    # Build a CFG from the productions
     print("\nBuinding a CFG...")
-    cfg_grammar = CFG(Nonterminal('S'), tbank_productions)  # a CFG
     print(cfg_grammar, end="\n\n")
 
     # CFG - An Earley parser
     cfg_earley_parser = EarleyChartParser(cfg_grammar, trace=3)
-    # Build a PCFG from the productions
 
     print("Building a PCFG...")
-    pcfg_grammar = induce_pcfg(Nonterminal('S'), tbank_productions_with_repet)  # a PCFG, here repetitions are needed!
     print(pcfg_grammar, end="\n\n")
 
     # Allocate a bottom-up chart parser for PCFG; see: http://www.nltk.org/_modules/nltk/parse/pchart.html
-    pcfg_pchart_parser = InsideChartParser(pcfg_grammar)
+    pcfg_pchart_parser = InstrumentedInsideChartParser(pcfg_grammar)  # the same parser, plus timers and counters
 
     return cfg_earley_parser, pcfg_pchart_parser # return both parsers
 
 
-def earley(parser, sentence, gold_tree):
-    ''' Earley parser for CFG: generates a list of parse trees'''
-    test_trees = parser.parse(sentence)  # get a list of Tree
-    # very bad transforming a generator into a list, but I want to know the number of tree found
-    # and it seems than it is not possible to scan a generator more than one time
-    test_trees = list(test_trees)
-    print("\n---> EARLEY CFG PARSER - TREES FOUND:", len(test_trees))
+def iter_trees(trees, max_trees=None, max_time=None):
+    ''' Generator: yields the trees of an iterator, stopping after max_trees trees or max_time seconds '''
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    for tree in itertools.islice(trees, max_trees):
+        if deadline is not None and time.perf_counter() > deadline:
+            return
+        yield tree
+
+
+class _EnumerationTimeout(Exception):
+    pass
+
+
+def iter_parses(chart, start, max_trees=None, max_time=None):
+    '''
+    Generator: yields the parse trees in a chart one at a time, in the same order as chart.parses(), walking the
+    packed forest depth first: only the tree being built is in memory (Chart.trees() instead builds the list of all
+    the trees of each edge first). Stops after max_trees trees, or after max_time seconds, also in the middle of a
+    tree. Trees that contain themselves (cycles) are skipped, as in Chart.trees()
+    '''
+    deadline = None if max_time is None else time.perf_counter() + max_time
+
+    def trees(edge, ancestors):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _EnumerationTimeout()
+        if isinstance(edge, LeafEdge):
+            yield chart.leaf(edge.start())
+            return
+        if edge in ancestors:
+            return
+        ancestors = ancestors | {edge}
+        for child_pointer_list in chart.child_pointer_lists(edge):
+            for children in combinations(child_pointer_list, ancestors):
+                yield Tree(edge.lhs().symbol(), list(children))
+
+    def combinations(edges, ancestors):
+        # as itertools.product(), but lazily: the trees of the other children are enumerated again for each tree
+        # of the first child, instead of being stored
+        if not edges:
+            yield ()
+            return
+        for first in trees(edges[0], ancestors):
+            for rest in combinations(edges[1:], ancestors):
+                yield (first,) + rest
+
+    roots = [edge for edge in chart.select(start=0, end=chart.num_leaves(), lhs=start) if edge.is_complete()]
+    try:
+        yield from iter_trees(itertools.chain.from_iterable(trees(root, frozenset()) for root in roots), max_trees)
+    except _EnumerationTimeout:
+        return
+
+
+def count_trees(chart, start):
+    '''
+    Number of parse trees in a chart, without building them: the chart is a packed forest, where each complete edge
+    shares its subtrees with all the edges that use it. Cycles add no tree, as in Chart.trees()
+    '''
+    memo = {}
+
+    def count(edge):
+        if isinstance(edge, LeafEdge):
+            return 1
+        if edge not in memo:
+            memo[edge] = 0  # if the edge is reached again while counting it, it is a cycle
+            total = 0
+            for child_pointer_list in chart.child_pointer_lists(edge):
+                product = 1
+                for child in child_pointer_list:
+                    product *= count(child)
+                total += product
+            memo[edge] = total
+        return memo[edge]
+
+    return sum(count(edge) for edge in chart.select(start=0, end=chart.num_leaves(), lhs=start) if edge.is_complete())
+
+
+def iter_best_parses(chart, grammar, max_trees=None, max_time=None):
+    '''
+    Generator: yields the parse trees in a chart as ProbabilisticTree, from the most probable one down, one at a
+    time (as InsideChartParser.parse() does, but without building and sorting all of them first); the chart can be
+    built by any chart parser for the PCFG grammar. Stops after max_trees trees, or after max_time seconds.
+    Best-first search on the packed forest: first the log-probability of the best tree of each edge is computed
+    (Viterbi); then partial trees are expanded in order of the best log-probability they can reach: the fixed
+    productions, plus the best trees of the edges still to expand. Trees that contain themselves (cycles) are
+    skipped, as in Chart.trees()
+    '''
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    logprobs = {(production.lhs(), production.rhs()): production.logprob() for production in grammar.productions()}
+    best = {}
+
+    def best_logprob(edge):
+        if isinstance(edge, LeafEdge):
+            return 0.0
+        if edge not in best:
+            best[edge] = -math.inf  # if the edge is reached again while scoring it, it is a cycle
+            best[edge] = max((logprobs[edge.lhs(), edge.rhs()] + sum(best_logprob(child) for child in children)
+                              for children in chart.child_pointer_lists(edge)), default=-math.inf)
+        return best[edge]
+
+    def build(expanded):
+        # expanded: the (edge, children) of a complete tree, in preorder; returns (tree, its log-probability)
+        edge, children = next(expanded)
+        if isinstance(edge, LeafEdge):
+            return chart.leaf(edge.start()), 0.0
+        subtrees = [build(expanded) for child in children]
+        logprob = logprobs[edge.lhs(), edge.rhs()] + sum(subtree_logprob for (subtree, subtree_logprob) in subtrees)
+        return ProbabilisticTree(edge.lhs().symbol(), [subtree for (subtree, subtree_logprob) in subtrees],
+                                 logprob=logprob), logprob
+
+    # a partial tree: (-bound, tie breaker, log-probability of the fixed productions, edges to expand with their
+    # ancestors, in preorder, expanded edges as a linked list (edge, children, previous), newest first)
+    queue = []
+    tie_breaker = itertools.count()
+    for root in chart.select(start=0, end=chart.num_leaves(), lhs=grammar.start()):
+        if root.is_complete() and best_logprob(root) > -math.inf:
+            queue.append((-best_logprob(root), next(tie_breaker), 0.0, ((root, frozenset()),), None))
+    heapq.heapify(queue)
+    n_trees = 0
+    while queue and (max_trees is None or n_trees < max_trees):
+        if deadline is not None and time.perf_counter() > deadline:
+            return
+        bound, _, logprob, to_expand, expanded = heapq.heappop(queue)
+        if not to_expand:   # a complete tree: no other partial tree can reach a higher log-probability
+            preorder = []
+            while expanded is not None:
+                edge, children, expanded = expanded
+                preorder.append((edge, children))
+            yield build(reversed(preorder))[0]
+            n_trees += 1
+            continue
+        (edge, ancestors), rest = to_expand[0], to_expand[1:]
+        if isinstance(edge, LeafEdge):
+            heapq.heappush(queue, (bound, next(tie_breaker), logprob, rest, (edge, (), expanded)))
+            continue
+        ancestors = ancestors | {edge}
+        for children in chart.child_pointer_lists(edge):
+            if any(child in ancestors for child in children):
+                continue
+            child_logprob = logprob + logprobs[edge.lhs(), edge.rhs()]
+            child_to_expand = tuple((child, ancestors) for child in children) + rest
+            child_bound = child_logprob + sum(best_logprob(child) for (child, child_ancestors) in child_to_expand)
+            if child_bound > -math.inf:
+                heapq.heappush(queue, (-child_bound, next(tie_breaker), child_logprob, child_to_expand,
+                                       (edge, children, expanded)))
+
+
+def earley(parser, sentence, gold_tree, max_trees=10, max_time=None):
+    ''' Earley parser for CFG: shows at most max_trees parse trees (or the ones found in max_time seconds) '''
+    chart = parser.chart_parse(sentence)
+    # the chart allows to count the trees, without building them (they could be thousands...)
+    print("\n---> EARLEY CFG PARSER - TREES FOUND:", count_trees(chart, parser.grammar().start()))
+    # trees are built one at a time, only when needed
+    test_trees = iter_parses(chart, parser.grammar().start(), max_trees, max_time)
     # look for the correct tree
     for idx, test_tree in enumerate(test_trees):
         print("TREE: #%d" % idx)
@@ -55,25 +303,25 @@ def earley(parser, sentence, gold_tree):
             print("WRONG TREE\n")
 
 
-def pchart(parser, sentence, gold_tree):
-    ''' Pchart parser for PCFG: generates a list of parse trees, with probabilities  '''
-
-    test_trees = parser.parse(sentence) # get an iterator on a list of ProbabilisticTree
-    # very bad transforming a list iterator into a list (it is needed by len(), as an iterator has no... length)
-    test_trees = list(test_trees)
-    print("\n---> PCHART PCFG PARSER - TREE(S) FOUND:", len(test_trees))
+def pchart(parser, sentence, gold_tree, max_trees=10, max_time=None):
+    '''
+    Chart parser for PCFG: shows at most max_trees parse trees (or the ones found in max_time seconds), from the most
+    probable one down, with their probabilities; returns the most probable tree (None if there is no tree)
+    '''
+    try:
+        chart = parser.chart_parse(sentence)
+    except ValueError:   # some words are not covered by the grammar
+        return None
+    # the chart allows to count the trees, without building them (they could be thousands...)
+    print("\n---> PCFG CHART PARSER - TREES FOUND:", count_trees(chart, parser.grammar().start()))
 
-    # look for the best tree
-    best_prob = 0.0
-    for idx, test_tree in enumerate(test_trees):      # NB: enumerate([a,b,c]) --> ((1,a),(2,b),(3,c))
+    # trees are built one at a time, only when needed, most probable first: the first one is the best tree
+    best_tree = None
+    for idx, test_tree in enumerate(iter_best_parses(chart, parser.grammar(), max_trees, max_time)):
         print("\nTREE: #%d" % idx)
         print(test_tree)
-
-        # if the probability of the current tree is higher than the current probability, it is the new "best tree"
-        curr_prob = test_tree.prob()
-        if curr_prob > best_prob:
+        if best_tree is None:
             best_tree = test_tree
-            best_prob = curr_prob
 
         # A parser does not have this information (it does not know the "correct tree"...)
         # This is just to understand whether the parser selected the correst tree, or a wrong tree, as its "best tree"
@@ -87,6 +335,296 @@ def pchart(parser, sentence, gold_tree):
     return best_tree   
 
 
+def compile_pcfg(pcfg_grammar):
+    '''
+    Transform the PCFG into Chomsky normal form and encode it with integer arrays (see CompiledPCFG):
+    - productions with more than 2 symbols on the right are right-binarized, A -> B C D becomes A -> B A|<C-D>, A|<C-D> -> C D
+    - terminals on the right of non-lexical productions are replaced by new preterminals
+    - chains of unary productions are replaced by their closure (the most probable chain between each pair of symbols)
+    '''
+    symbol_ids = {}
+    symbols = []
+    intermediate = []
+
+    def symbol_id(symbol, is_intermediate=False):
+        if symbol not in symbol_ids:
+            symbol_ids[symbol] = len(symbols)
+            symbols.append(symbol)
+            intermediate.append(is_intermediate)
+        return symbol_ids[symbol]
+
+    lexical = {}
+    binary = {}   # (A, B, C) --> logprob
+    unary = {}    # (A, B) --> logprob
+
+    def add_lexical(word, parent, logprob):
+        lexical.setdefault(word, {})[parent] = logprob
+
+    start = symbol_id(pcfg_grammar.start())
+    for production in pcfg_grammar.productions():
+        parent = symbol_id(production.lhs())
+        logprob = math.log2(production.prob())
+        rhs = production.rhs()
+        if len(rhs) == 1 and not isinstance(rhs[0], Nonterminal):
+            add_lexical(rhs[0], parent, logprob)   # A -> 'word'
+            continue
+        children = []
+        for child in rhs:
+            if isinstance(child, Nonterminal):
+                children.append(symbol_id(child))
+            else:
+                # a terminal among nonterminals: a new preterminal "'word'" with probability 1
+                preterminal = symbol_id(Nonterminal("'%s'" % child), is_intermediate=True)
+                add_lexical(child, preterminal, 0.0)
+                children.append(preterminal)
+        if len(children) == 1:
+            unary[parent, children[0]] = logprob
+            continue
+        # right binarization; intermediate symbols are shared by productions with the same right suffix
+        while len(children) > 2:
+            rest = Nonterminal("%s|<%s>" % (production.lhs().symbol(),
+                                            "-".join(symbols[child].symbol() for child in children[1:])))
+            rest_id = symbol_id(rest, is_intermediate=True)
+            binary[parent, children[0], rest_id] = logprob
+            parent, children, logprob = rest_id, children[1:], 0.0
+        binary[parent, children[0], children[1]] = logprob
+
+    # unary closure: the best chains are found relaxing them until nothing improves
+    # (probabilities are <= 1, so cycles never improve a chain)
+    closure = dict(unary)
+    unary_next = {(parent, child): child for (parent, child) in unary}
+    changed = True
+    while changed:
+        changed = False
+        for (parent, middle), logprob in unary.items():
+            for (middle2, child), chain_logprob in list(closure.items()):
+                if middle2 != middle or child == parent:
+                    continue
+                if logprob + chain_logprob > closure.get((parent, child), -math.inf):
+                    closure[parent, child] = logprob + chain_logprob
+                    unary_next[parent, child] = middle
+                    changed = True
+    unary_items = sorted(closure.items())
+
+    return CompiledPCFG(
+        symbols, start, np.array(intermediate, dtype=bool),
+        {word: (np.array(list(parents), dtype=np.intp), np.array(list(parents.values())))
+         for word, parents in lexical.items()},
+        np.array([key[0] for key in binary], dtype=np.intp), np.array([key[1] for key in binary], dtype=np.intp),
+        np.array([key[2] for key in binary], dtype=np.intp), np.array(list(binary.values())),
+        np.array([key[0] for key, logprob in unary_items], dtype=np.intp),
+        np.array([key[1] for key, logprob in unary_items], dtype=np.intp),
+        np.array([logprob for key, logprob in unary_items]), unary_next)
+
+
+def _best_by_parent(parents, scores):
+    ''' Indexes of the best (finite) score of each parent; returns (parents, indexes) '''
+    candidates = np.flatnonzero(scores > -np.inf)
+    if len(candidates) == 0:
+        return candidates, candidates
+    order = candidates[np.lexsort((-scores[candidates], parents[candidates]))]
+    best_parents, first = np.unique(parents[order], return_index=True)
+    return best_parents, order[first]
+
+
+def _back_pointer(back_pointers, i, j, symbol):
+    ''' The back pointer of symbol in the cell [i, j), or None; back_pointers: {(i, j): (sorted symbols, values...)} '''
+    entry = back_pointers.get((i, j))
+    if entry is None:
+        return None
+    k = np.searchsorted(entry[0], symbol)
+    if k == len(entry[0]) or entry[0][k] != symbol:
+        return None
+    return tuple(int(values[k]) for values in entry[1:])
+
+
+def cky(grammar, sentence, threshold=None):
+    '''
+    Viterbi CKY parser for a CompiledPCFG: returns the most probable ProbabilisticTree of the sentence, or None.
+    threshold: if given, prune the symbols of each chart cell whose log2-probability is lower than
+               the best one of the cell minus threshold (faster, but the best tree may be lost)
+    Only the spans [i, j) with i < j have a cell of scores; back pointers are kept only for the symbols built in
+    each cell, so they grow with the symbols actually built, not with the size of the grammar
+    '''
+    n = len(sentence)
+    n_symbols = len(grammar.symbols)
+
+    def cell_index(i, j):
+        # cells are stored row by row: [0, 1), [0, 2), ..., [0, n), [1, 2), ..., [n - 1, n)
+        return i * n - i * (i - 1) // 2 + j - i - 1
+
+    # inside log-probabilities of each span [i, j), after the unary closure
+    chart = np.full((n * (n + 1) // 2, n_symbols), -np.inf)
+    binary_back = {}   # (i, j) --> (parents, rules, split points)
+    unary_back = {}    # (i, j) --> (parents, children of their best unary chains)
+
+    def close_cell(i, j, cell):
+        scores = cell[grammar.unary_child] + grammar.unary_logprob
+        parents, best = _best_by_parent(grammar.unary_parent, scores)
+        better = scores[best] > cell[parents]
+        if better.any():
+            cell[parents[better]] = scores[best[better]]
+            unary_back[i, j] = (parents[better].astype(np.int32), grammar.unary_child[best[better]].astype(np.int32))
+        if threshold is not None:
+            cell[cell < cell.max() - threshold] = -np.inf
+        chart[cell_index(i, j)] = cell
+
+    for i, word in enumerate(sentence):
+        cell = np.full(n_symbols, -np.inf)
+        if word in grammar.lexical:
+            parents, logprobs = grammar.lexical[word]
+            cell[parents] = logprobs
+        close_cell(i, i + 1, cell)
+
+    for length in range(2, n + 1):
+        for i in range(0, n - length + 1):
+            j = i + length
+            # all the split points at once: scores[k, rule]
+            left = chart[cell_index(i, i + 1):cell_index(i, j)]                # [i, k) for i < k < j: contiguous
+            right = chart[[cell_index(k, j) for k in range(i + 1, j)]]         # [k, j)
+            scores = left[:, grammar.binary_left] + right[:, grammar.binary_right] + grammar.binary_logprob
+            best_split = scores.argmax(axis=0)
+            scores = scores[best_split, np.arange(len(best_split))]
+            parents, best = _best_by_parent(grammar.binary_parent, scores)
+            cell = np.full(n_symbols, -np.inf)
+            cell[parents] = scores[best]
+            if len(parents):
+                binary_back[i, j] = (parents.astype(np.int32), best.astype(np.int32),
+                                     (i + 1 + best_split[best]).astype(np.int32))
+            close_cell(i, j, cell)
+
+    if n == 0 or chart[cell_index(0, n), grammar.start] == -np.inf:
+        return None
+
+    def build(i, j, symbol, closed=True):
+        ''' The list of children that symbol contributes to its parent (a single tree, unless intermediate) '''
+        unary = _back_pointer(unary_back, i, j, symbol) if closed else None
+        binary = _back_pointer(binary_back, i, j, symbol) if unary is None else None
+        if unary is not None:
+            # follow the unary chain symbol -> ... -> child
+            child, = unary
+            next_symbol = grammar.unary_next[symbol, child]
+            if next_symbol == child:
+                children = build(i, j, child, closed=False)
+            else:
+                children = build(i, j, next_symbol)   # the rest of the chain
+        elif j == i + 1 and binary is None:
+            children = [sentence[i]]   # lexical production
+        else:
+            rule, k = binary
+            children = build(i, k, grammar.binary_left[rule]) + build(k, j, grammar.binary_right[rule])
+        if grammar.intermediate[symbol]:
+            return children
+        return [Tree(grammar.symbols[symbol].symbol(), children)]
+
+    # the chain to follow from the start symbol is the one chosen by the unary closure of the whole sentence
+    tree = build(0, n, grammar.start)[0]
+    return ProbabilisticTree(tree.label(), list(tree), logprob=chart[cell_index(0, n), grammar.start])
+
+
+def benchmark_parsers(pchart_parser, compiled_pcfg, sentences):
+    ''' Parse the sentences with InsideChartParser and with cky(); compare times and best trees '''
+    pchart_time = cky_time = 0.0
+    for sentence in sentences:
+        start = time.perf_counter()
+        try:
+            pchart_tree = next(pchart_parser.parse(sentence), None)   # trees are sorted by probability
+        except ValueError:   # some words are not covered by the grammar
+            pchart_tree = None
+        pchart_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        cky_tree = cky(compiled_pcfg, sentence)
+        cky_time += time.perf_counter() - start
+
+        if pchart_tree is None or cky_tree is None:
+            same = pchart_tree is cky_tree
+        else:
+            same = (pchart_tree.productions() == cky_tree.productions() and
+                    math.isclose(pchart_tree.logprob(), cky_tree.logprob(), rel_tol=1e-9))
+        print("%-4s %s" % ("OK" if same else "DIFF", ' '.join(sentence)))
+
+    print("InsideChartParser: %.3f s" % pchart_time)
+    print("CKY              : %.3f s" % cky_time)
+
+
+# the grammar used by the worker processes of parse_batch(), loaded once in each worker by _init_parse_worker()
+_worker_grammar = None
+
+
+class ParseTimeout(Exception):
+    ''' Raised when parsing a sentence takes more time than allowed '''
+    pass
+
+
+def _raise_parse_timeout(signum, frame):
+    raise ParseTimeout()
+
+
+def _init_parse_worker(n1, n2, cache_dir):
+    global _worker_grammar
+    productions, counts = load_production_counts(n1, n2, cache_dir)
+    _worker_grammar = compile_pcfg(induce_grammars(productions, counts)[1])
+    signal.signal(signal.SIGALRM, _raise_parse_timeout)
+
+
+def _parse_with_timeout(job):
+    ''' Worker process: parse a sentence with cky(), interrupting it after timeout seconds (never if None) '''
+    sentence, timeout = job
+    start = time.perf_counter()
+    if timeout is None:
+        tree = cky(_worker_grammar, sentence)
+        return tree, "ok" if tree is not None else "no parse", time.perf_counter() - start
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            tree, status = cky(_worker_grammar, sentence), "ok"
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except ParseTimeout:
+        tree, status = None, "timeout"
+    if tree is None and status == "ok":
+        status = "no parse"
+    return tree, status, time.perf_counter() - start
+
+
+def parse_batch(sentences, n1, n2, processes=None, timeout=10.0, cache_dir='grammar_cache'):
+    '''
+    Generator: parses the sentences (an iterable of lists of tokens) with a pool of processes, each one loading the
+    grammar induced from treebank sentences n1 <= i < n2 once. Parsing a sentence is interrupted after timeout seconds
+    (None: no timeout). Yields (best tree or None, status, seconds) for each sentence, in the same order of the
+    sentences; status is "ok", "no parse" or "timeout". At most 2 sentences per process are in flight (being parsed,
+    or parsed and waiting to be consumed), so memory does not grow with the number of sentences
+    '''
+    load_production_counts(n1, n2, cache_dir)  # so that the cache is written once, before workers start
+    jobs = ((sentence, timeout) for sentence in sentences)
+    with Pool(processes, initializer=_init_parse_worker, initargs=(n1, n2, cache_dir)) as pool:
+        yield from bounded_pool.imap_bounded(pool, _parse_with_timeout, jobs, 2 * (processes or os.cpu_count()))
+
+
+def percentile(values, q):
+    ''' The q-th percentile (0 <= q <= 100) of a sorted list of values, nearest-rank method '''
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def parse_corpus(sentences, n1, n2, processes=None, timeout=10.0):
+    ''' Parse the sentences with parse_batch(); print throughput and per-sentence latencies '''
+    statuses = Counter()
+    latencies = []
+    start = time.perf_counter()
+    for tree, status, seconds in parse_batch(sentences, n1, n2, processes, timeout):
+        statuses[status] += 1
+        latencies.append(seconds)
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        return
+    latencies.sort()
+    print("Parsed %d sentences in %.2f s: %.1f sentences/s" % (len(latencies), elapsed, len(latencies) / elapsed))
+    print("Results:", ", ".join("%s %d" % (status, count) for status, count in sorted(statuses.items())))
+    print("Latency: p50 %.4f s, p99 %.4f s, max %.4f s\n" % (percentile(latencies, 50), percentile(latencies, 99),
+                                                             latencies[-1]))
+
+
 def main():
     
     # Read sentence i of the treebank, with n1 <= i < n2
@@ -101,22 +639,40 @@ def main():
     m1 = 0    
     m2 = 1
 
+    instrument = False  # if True, time the hot paths: the trace is written to 'parser_trace.jsonl', the profile to 'parser.pstats'
+    if instrument:
+        instrumentation.enable(trace_path='parser_trace.jsonl', profile=True)
+        atexit.register(instrumentation.finish, 'parser.pstats')  # report at the end
+
     # Induce grammar from a subset of the treebank parsed sentences. Allocate parsers
-    cfg_earley_parser, pcfg_pchart_parser = generate_grammar_and_parsers(treebank.parsed_sents()[n1:n2])
+    cfg_earley_parser, pcfg_pchart_parser = generate_grammar_and_parsers(n1, n2)
 
-    # Parse sentences from the treebank
-    for i in range(m1,m2):
-        sentence = treebank.sents()[i]  # the sentence to parse
+    # The treebank, converted once into a memory-mapped snapshot (see corpus_cache.py): any sentence is read in O(1)
+    corpus = corpus_cache.treebank()
+
+    # Compare the parser for PCFG with a (much faster) Viterbi CKY parser, on the same sentences
+    compiled_pcfg = compile_pcfg(pcfg_pchart_parser.grammar())
+    benchmark_parsers(pcfg_pchart_parser, compiled_pcfg, corpus.sents()[m1:m2])
+
+    # A chart parser for the PCFG: pchart() enumerates the trees of its chart, most probable first
+    pcfg_chart_parser = ChartParser(pcfg_pchart_parser.grammar())
+
+    # Parse many sentences in batch, with a pool of processes (sentences taking more than 10 s are given up)
+    parse_corpus(corpus.sents()[n1:n2], n1, n2, timeout=10.0)
+
+    # Parse sentences from the treebank (each sentence, with its right parse tree, is read only once)
+    for sentence, gold_tree in zip(corpus.sents()[m1:m2], corpus.parsed_sents()[m1:m2]):
         print("Parsing:", sentence)
         
-        gold_tree = treebank.parsed_sents()[i]  # the right parse tree
-        
         # Parse the sentence with parsers we define; 
         # see: 
         # http://www.nltk.org/book/ch08-extras.html
         # http://www.nltk.org/book/ch08.html
-        earley(cfg_earley_parser, sentence, gold_tree) # here do not return any tree... just show all of them
-        tree = pchart(pcfg_pchart_parser, sentence, gold_tree) # here get the best tree
+        earley(cfg_earley_parser, sentence, gold_tree) # here do not return any tree... just show some of them
+        tree = pchart(pcfg_chart_parser, sentence, gold_tree) # here get the best tree
+        if tree is None:
+            print("\nNO TREE FOUND")
+            continue
         print("\nBEST TREE WITH PROB.: %.12e" % tree.prob())
         tree.draw()  # draw the tree
 
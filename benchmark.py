@@ -0,0 +1,261 @@
+'''
+Benchmarks of the tagger, the parser, the WSD lab and the word counts, on fixed slices of the corpora.
+
+Each stage runs in a process of its own, so that its peak memory (RSS) is measured alone; the wall time and the
+throughput of each step are appended, with the peak memory of the stage, to a JSON history. Each run is compared
+with the previous ones, and regressions are reported. E.g.:
+    python benchmark.py                  # all the stages
+    python benchmark.py tagger parser    # only some stages
+    python benchmark.py --compare        # compare the last run of the history with the previous ones
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import multiprocessing
+import importlib.util
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.path.join(ROOT, 'benchmark_history.json')
+
+
+def load_script(name, path):
+    '''
+    Imports a script of the repository as a module (their file names, e.g. 4_HMM_POS_tagger.py, are not valid module
+    names); the module is registered in sys.modules, so that its functions can be sent to worker processes.
+    NB: only forked workers inherit the registration (a spawned worker could not import the module): stages run
+    with the 'fork' start method, see run_stage_here()
+    '''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class StepTimer:
+    ''' Wall time, number of processed items and throughput of the steps of a stage '''
+    def __init__(self):
+        self.steps = {}
+
+    def run(self, step, function, items):
+        '''
+        Calls function() and returns its result; items: how many items (e.g., tokens) the step processed,
+        or a function that counts them in the result (not timed)
+        '''
+        start = time.perf_counter()
+        result = function()
+        wall_time = time.perf_counter() - start
+        if callable(items):
+            items = items(result)
+        self.steps[step] = {'wall_time': wall_time, 'items': items,
+                            'throughput': items / wall_time if wall_time > 0 else None}
+        return result
+
+
+def n_tokens(tagged_sentences):
+    return sum(len(tagged_sentence) for tagged_sentence in tagged_sentences)
+
+
+def bench_tagger(timer):
+    '''
+    HMM tagger: load the 'news' section of the Brown corpus, train on 80% of it (in this process, and with a pool of
+    processes: the two models must be the same), tag 500 test sentences
+    '''
+    tagger = load_script('hmm_pos_tagger', '4_HMM_POS_tagger.py')
+    tagged_sentences, words, tag_set = timer.run('load_corpus', lambda: tagger.load_corpus('news'),
+                                                 lambda corpus: n_tokens(corpus[0]))
+    train_set, test_set = tagger.split_corpus(tagged_sentences, 0.8)
+    test_set = test_set[:500]
+    hmm = timer.run('train', lambda: tagger.train(train_set, words, tag_set), n_tokens(train_set))
+    parallel_hmm = timer.run('train_parallel', lambda: tagger.train_parallel(train_set, words, tag_set),
+                             n_tokens(train_set))
+    tables, parallel_tables = tagger.compile_tables(hmm), tagger.compile_tables(parallel_hmm)
+    if not all(tagger.np.array_equal(getattr(tables, name), getattr(parallel_tables, name))
+               for name in ('initial', 'transition', 'emission')):
+        raise RuntimeError("train_parallel() and train() trained different models")
+    timer.run('best_path', lambda: [hmm.best_path([word for (word, tag) in tagged_sentence])
+                                    for tagged_sentence in test_set], n_tokens(test_set))
+
+
+def bench_parser(timer):
+    '''
+    Parsers: induce the grammars from the first 200 parsed sentences of the treebank, then parse their (at most
+    20) sentences of at most 10 words with the Earley parser (the whole chart) and the InsideChart parser (the best tree)
+    '''
+    parser = load_script('pparser', '5_parser_pparser_simplified.py')
+    from nltk.corpus import treebank
+    from nltk.parse import EarleyChartParser
+    from nltk.parse.pchart import InsideChartParser
+    n1, n2 = 0, 200
+    productions, counts = timer.run('count_productions',
+                                    lambda: parser.count_productions(treebank.parsed_sents()[n1:n2]), n2 - n1)
+    cfg_grammar, pcfg_grammar = timer.run('induce_grammars', lambda: parser.induce_grammars(productions, counts),
+                                          len(productions))
+    sentences = [sentence for sentence in treebank.sents()[n1:n2] if len(sentence) <= 10][:20]
+    earley_parser = EarleyChartParser(cfg_grammar)
+    timer.run('earley', lambda: [earley_parser.chart_parse(sentence) for sentence in sentences], len(sentences))
+    pchart_parser = InsideChartParser(pcfg_grammar)
+    timer.run('inside_chart', lambda: [next(iter(pchart_parser.parse(sentence)), None) for sentence in sentences],
+              len(sentences))
+
+
+def bench_wsd(timer):
+    ''' WSD lab: lemmatize the training files of 'apple', extract the featuresets, train and classify (80% / 20%) '''
+    wsd = load_script('naivebayeswsd', os.path.join('lab3-WSD', 'naivebayeswsd_tobecompleted.py'))
+    data_dir = os.path.join(ROOT, 'lab3-WSD', 'data')
+    texts = {'FRUIT': os.path.join(data_dir, 'apple-fruit-training.txt'),
+             'COMPANY': os.path.join(data_dir, 'apple-company-training.txt')}
+    index = timer.run('lemmatize', lambda: wsd.LemmaIndex.from_files(texts),
+                      lambda index: sum(len(document) for document in index.documents.values()))
+
+    def featurize():
+        best_co_occurring_lemmas = index.best_co_occurring_lemmas('apple', 12, 1)
+        return [(wsd.features(word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas), sense)
+                for sense in texts
+                for idx, word, left_context_lemmas, right_context_lemmas in index.occurrences(sense, 'apple', 1)]
+    featuresets = timer.run('featurize', featurize, len)
+    wsd.random.Random(1).shuffle(featuresets)
+    train_set_limit = int(0.8 * len(featuresets))
+    train_set, test_set = featuresets[:train_set_limit], featuresets[train_set_limit:]
+    classifier = timer.run('train', lambda: wsd.NumpyNaiveBayesClassifier.train(train_set), len(train_set))
+    timer.run('classify', lambda: classifier.classify_many([featureset for (featureset, sense) in test_set]),
+              len(test_set))
+
+
+def bench_zipf(timer):
+    ''' Word counts of Emma (Jane Austen): FreqDist of the corpus reader, and the chunked parallel count_words() '''
+    zipfs_law = load_script('zipfs_law', '3_zipfs_law.py')
+    from nltk import FreqDist
+    from nltk.corpus import gutenberg
+    fdist = timer.run('freqdist', lambda: FreqDist(gutenberg.words('austen-emma.txt')), FreqDist.N)
+    timer.run('count_words', lambda: zipfs_law.count_words([gutenberg.abspath('austen-emma.txt')], encoding='latin1'),
+              fdist.N())
+
+
+STAGES = {'tagger': bench_tagger, 'parser': bench_parser, 'wsd': bench_wsd, 'zipf': bench_zipf}
+
+
+def peak_rss_kb():
+    ''' Peak resident memory of this process, in kB (ru_maxrss is in bytes on macOS, in kB elsewhere) '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+
+def run_stage_here(stage):
+    ''' Runs a stage in this process, and prints its results (JSON) as the last line of the output '''
+    multiprocessing.set_start_method('fork', force=True)  # the pools of the scripts need the modules of load_script()
+    timer = StepTimer()
+    STAGES[stage](timer)
+    print(json.dumps({'steps': timer.steps, 'peak_rss_kb': peak_rss_kb()}))
+
+
+def run_stage(stage):
+    ''' Runs a stage in a new process, so that its peak memory is not mixed with the one of the other stages '''
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-stage', stage], cwd=ROOT,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    if completed.returncode != 0:
+        raise RuntimeError("stage '%s' failed (exit status %d)" % (stage, completed.returncode))
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, universal_newlines=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, 'r') as history_file:
+        return json.load(history_file)
+
+
+def save_history(history, history_path):
+    with open(history_path + '.tmp', 'w') as history_file:
+        json.dump(history, history_file, indent=1)
+    os.replace(history_path + '.tmp', history_path)  # no half-written history, if interrupted
+
+
+def compare(run, history, window=5, tolerance=0.1):
+    '''
+    Compares a run with the median of (at most) the last window runs of the history that have the same stages:
+    a step slower, or a stage with a higher peak memory, by more than tolerance (e.g., 0.1: 10%) is a regression.
+    Returns the list of the regressions, as (stage, step or 'peak_rss_kb', baseline, value)
+    '''
+    regressions = []
+    for stage, results in run['stages'].items():
+        previous = [old_run['stages'][stage] for old_run in history if stage in old_run['stages']][-window:]
+        if not previous:
+            continue
+        baseline = statistics.median(old_results['peak_rss_kb'] for old_results in previous)
+        if results['peak_rss_kb'] > baseline * (1 + tolerance):
+            regressions.append((stage, 'peak_rss_kb', baseline, results['peak_rss_kb']))
+        for step, step_results in results['steps'].items():
+            times = [old_results['steps'][step]['wall_time'] for old_results in previous if step in old_results['steps']]
+            if times and step_results['wall_time'] > statistics.median(times) * (1 + tolerance):
+                regressions.append((stage, step, statistics.median(times), step_results['wall_time']))
+    return regressions
+
+
+def print_run(run, regressions):
+    print("Run of %s (commit %s, Python %s)" % (run['time'], run['commit'], run['python']))
+    for stage, results in run['stages'].items():
+        print("%s: peak RSS %.1f MB" % (stage, results['peak_rss_kb'] / 1024))
+        for step, step_results in results['steps'].items():
+            print("\t%-20s %9.3f s %12s items/s" % (step, step_results['wall_time'],
+                                                    "%.1f" % step_results['throughput']
+                                                    if step_results['throughput'] is not None else "-"))
+    for stage, step, baseline, value in regressions:
+        if step == 'peak_rss_kb':
+            print("REGRESSION %s: peak RSS %.1f MB (was %.1f MB)" % (stage, value / 1024, baseline / 1024))
+        else:
+            print("REGRESSION %s.%s: %.3f s (was %.3f s)" % (stage, step, value, baseline))
+    if not regressions:
+        print("No regressions")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argument_parser.add_argument('stages', nargs='*', help="stages to run: %s (default: all)" % ', '.join(STAGES))
+    argument_parser.add_argument('--history', default=HISTORY_PATH, help="JSON history of the runs")
+    argument_parser.add_argument('--compare', action='store_true',
+                                 help="do not run: compare the last run of the history with the previous ones")
+    argument_parser.add_argument('--window', type=int, default=5, help="previous runs used as the baseline")
+    argument_parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown (0.1: 10%%) that is reported")
+    argument_parser.add_argument('--run-stage', choices=list(STAGES), help=argparse.SUPPRESS)  # in a child process
+    args = argument_parser.parse_args()
+
+    if args.run_stage:
+        run_stage_here(args.run_stage)
+        return
+
+    unknown_stages = [stage for stage in args.stages if stage not in STAGES]
+    if unknown_stages:
+        argument_parser.error("unknown stages: %s" % ', '.join(unknown_stages))
+
+    history = load_history(args.history)
+    if args.compare:
+        if not history:
+            sys.exit("No runs in %s" % args.history)
+        run, history = history[-1], history[:-1]
+    else:
+        run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(),
+               'stages': {stage: run_stage(stage) for stage in (args.stages or STAGES)}}
+        save_history(history + [run], args.history)
+    regressions = compare(run, history, args.window, args.tolerance)
+    print_run(run, regressions)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+'''
+Backpressure for process pools: Pool.imap() reads its whole input as fast as it can, so a large (or endless) input,
+and the results not yet consumed, can fill the memory. imap_bounded() keeps only a few tasks in flight. E.g.:
+    from multiprocessing import Pool
+    import bounded_pool
+    with Pool() as pool:
+        for result in bounded_pool.imap_bounded(pool, function, items, 2 * os.cpu_count()):
+            ...                        # stopping early (break, an exception) leaves nothing blocked in the pool
+'''
+
+import itertools
+from collections import deque
+
+
+def imap_bounded(pool, function, iterable, max_in_flight):
+    '''
+    Generator: the same results as pool.imap(function, iterable), in the same order, but at most max_in_flight
+    items (e.g., 2 per process of the pool) are submitted and not yet consumed.
+    Items are read and submitted (with apply_async()) by the consuming thread, only when a result is consumed: no
+    thread of the pool waits for the consumer, so the pool can always be terminated, even if the consumer stops early
+    '''
+    items = iter(iterable)
+    pending = deque(pool.apply_async(function, (item,)) for item in itertools.islice(items, max_in_flight))
+    while pending:
+        result = pending.popleft().get()   # the exception of the worker, if any, is raised here
+        for item in itertools.islice(items, 1):   # refill before yielding: the pool keeps working meanwhile
+            pending.append(pool.apply_async(function, (item,)))
+        yield result
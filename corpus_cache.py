@@ -0,0 +1,226 @@
+'''
+Compact, cached snapshots of the NLTK corpora used by the scripts (Brown, Penn treebank, Gutenberg).
+
+Each corpus is read (and parsed) once, and saved as a directory of .npy arrays plus a JSON header: tokens are
+interned (one id per distinct token), tags are small integers, and parse trees are kept in bracketed format.
+Snapshots are memory-mapped when loaded: loading is almost instantaneous, and any sentence is accessed in O(1). E.g.:
+    import corpus_cache
+    treebank = corpus_cache.treebank()                 # built on the first call, then loaded from 'corpus_cache'
+    sentence, tree = treebank.sents()[7], treebank.parsed_sents()[7]
+'''
+
+import os
+import json
+import shutil
+from collections import Counter
+import numpy as np
+from nltk.tree import Tree
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_DIR = 'corpus_cache'
+
+
+class CorpusSnapshot:
+    '''
+    A corpus of sentences, as arrays:
+    - vocabulary: the distinct tokens (the id of a token is its position); tagset: the distinct tags
+    - tokens: the token ids of all the sentences, one sentence after the other
+    - offsets: sentence i is tokens[offsets[i]:offsets[i + 1]]
+    - tags (tagged corpora): the tag id of each token; uint8, or uint16 if there are more than 256 tags
+    - trees, tree_offsets (parsed corpora): the parse tree of sentence i, in bracketed format (UTF-8),
+      is trees[tree_offsets[i]:tree_offsets[i + 1]]
+    '''
+    def __init__(self, vocabulary, tokens, offsets, tagset=None, tags=None, trees=None, tree_offsets=None):
+        self.vocabulary = vocabulary
+        self.tokens = tokens
+        self.offsets = offsets
+        self.tagset = tagset
+        self.tags = tags
+        self.trees = trees
+        self.tree_offsets = tree_offsets
+
+    @classmethod
+    def build(cls, sentences, tagged=False, parsed=False):
+        '''
+        Converts the sentences of a corpus: lists of tokens, lists of (token, tag) if tagged, or parse trees if parsed
+        (their tokens and tags are the leaves and the preterminals, as in the tagged_sents() of the treebank)
+        '''
+        token_ids, tag_ids = {}, {}   # token --> id, tag --> id
+        tokens, tags, offsets = [], [], [0]
+        trees, tree_offsets = bytearray(), [0]
+        for sentence in sentences:
+            if parsed:
+                trees += sentence.pformat(margin=float('inf')).encode('utf-8')   # a single line
+                tree_offsets.append(len(trees))
+                sentence = sentence.pos()
+            if tagged or parsed:
+                for token, tag in sentence:
+                    tokens.append(token_ids.setdefault(token, len(token_ids)))
+                    tags.append(tag_ids.setdefault(tag, len(tag_ids)))
+            else:
+                tokens.extend(token_ids.setdefault(token, len(token_ids)) for token in sentence)
+            offsets.append(len(tokens))
+        snapshot = cls(list(token_ids), np.array(tokens, dtype=np.uint32), np.array(offsets, dtype=np.int64))
+        if tagged or parsed:
+            snapshot.tagset = list(tag_ids)
+            snapshot.tags = np.array(tags, dtype=np.uint8 if len(tag_ids) <= 256 else np.uint16)
+        if parsed:
+            snapshot.trees = np.frombuffer(bytes(trees), dtype=np.uint8)
+            snapshot.tree_offsets = np.array(tree_offsets, dtype=np.int64)
+        return snapshot
+
+    def _arrays(self):
+        return {name: getattr(self, name) for name in ('tokens', 'offsets', 'tags', 'trees', 'tree_offsets')
+                if getattr(self, name) is not None}
+
+    def save(self, snapshot_path):
+        ''' Saves the snapshot to the directory snapshot_path: a JSON header and one .npy file for each array '''
+        os.makedirs(snapshot_path, exist_ok=True)
+        arrays = self._arrays()
+        for name, array in arrays.items():
+            np.save(os.path.join(snapshot_path, name + '.npy'), array)
+        header = {'format_version': SNAPSHOT_FORMAT_VERSION,
+                  'vocabulary': self.vocabulary,
+                  'tagset': self.tagset,
+                  'arrays': {name: {'dtype': str(array.dtype), 'shape': list(array.shape)}
+                             for name, array in arrays.items()}}
+        # the header is written last: a directory without it is an incomplete snapshot
+        with open(os.path.join(snapshot_path, 'header.json'), 'w', encoding='utf-8') as header_file:
+            json.dump(header, header_file)
+
+    @classmethod
+    def load(cls, snapshot_path):
+        ''' Loads a snapshot saved by save(); arrays are memory-mapped (read only), not copied '''
+        with open(os.path.join(snapshot_path, 'header.json'), encoding='utf-8') as header_file:
+            header = json.load(header_file)
+        if header['format_version'] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError("Unsupported snapshot format version %s in %s" % (header['format_version'], snapshot_path))
+        arrays = {}
+        for name, description in header['arrays'].items():
+            arrays[name] = np.load(os.path.join(snapshot_path, name + '.npy'), mmap_mode='r')
+            if list(arrays[name].shape) != description['shape']:
+                raise ValueError("Corrupted snapshot: unexpected shape of %s in %s" % (name, snapshot_path))
+        return cls(header['vocabulary'], tagset=header['tagset'], **arrays)
+
+    def __len__(self):
+        ''' The number of sentences '''
+        return len(self.offsets) - 1
+
+    def sentence(self, i, vocabulary=None):
+        ''' The tokens of sentence i; vocabulary: the strings of the token ids, if not self.vocabulary '''
+        vocabulary = vocabulary or self.vocabulary
+        return [vocabulary[token] for token in self.tokens[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def tagged_sentence(self, i, vocabulary=None, tagset=None):
+        ''' The pairs (token, tag) of sentence i '''
+        vocabulary = vocabulary or self.vocabulary
+        tagset = tagset or self.tagset
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [(vocabulary[token], tagset[tag])
+                for token, tag in zip(self.tokens[start:end].tolist(), self.tags[start:end].tolist())]
+
+    def tree(self, i):
+        ''' The parse tree of sentence i '''
+        return Tree.fromstring(self.trees[self.tree_offsets[i]:self.tree_offsets[i + 1]].tobytes().decode('utf-8'))
+
+    def sents(self, normalize_token=None):
+        '''
+        The sentences, as a lazy sequence (it supports len(), indexing and slicing, as NLTK corpus views do);
+        normalize_token (e.g., str.lower) is applied once to each distinct token, not to each occurrence
+        '''
+        vocabulary = _normalized(self.vocabulary, normalize_token)
+        return SentenceView(lambda i: self.sentence(i, vocabulary), range(len(self)))
+
+    def tagged_sents(self, normalize_token=None, normalize_tag=None):
+        ''' The tagged sentences, as a lazy sequence; normalize_tag is applied once to each distinct tag '''
+        vocabulary = _normalized(self.vocabulary, normalize_token)
+        tagset = _normalized(self.tagset, normalize_tag)
+        return SentenceView(lambda i: self.tagged_sentence(i, vocabulary, tagset), range(len(self)))
+
+    def parsed_sents(self):
+        ''' The parse trees, as a lazy sequence '''
+        return SentenceView(self.tree, range(len(self)))
+
+    def words(self):
+        ''' The list of all the tokens '''
+        return [self.vocabulary[token] for token in self.tokens.tolist()]
+
+    def word_counts(self):
+        ''' Counter of the tokens, computed on the token ids '''
+        counts = np.bincount(self.tokens, minlength=len(self.vocabulary))
+        return Counter(dict(zip(self.vocabulary, counts.tolist())))
+
+
+def _normalized(strings, normalize):
+    return strings if normalize is None else [normalize(string) for string in strings]
+
+
+class SentenceView:
+    ''' A lazy sequence of the sentences (or trees) of a snapshot: a sentence is built only when accessed '''
+    def __init__(self, get, indexes):
+        self._get = get
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return SentenceView(self._get, self._indexes[i])
+        return self._get(self._indexes[i])
+
+    def __iter__(self):
+        for i in self._indexes:
+            yield self._get(i)
+
+
+def cached(name, build, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Loads the snapshot called name from cache_dir; if it is missing (or in an older format), it is built by
+    build() and saved first
+    '''
+    snapshot_path = os.path.join(cache_dir, name)
+    try:
+        return CorpusSnapshot.load(snapshot_path)
+    except (OSError, ValueError):
+        pass
+    snapshot = build()
+    shutil.rmtree(snapshot_path + '.tmp', ignore_errors=True)
+    snapshot.save(snapshot_path + '.tmp')
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    os.replace(snapshot_path + '.tmp', snapshot_path)  # no half-written snapshot, if interrupted
+    return CorpusSnapshot.load(snapshot_path)
+
+
+def _name(corpus, selection):
+    ''' The name of the snapshot of some categories (or files) of a corpus; selection: None (all), a name or a list '''
+    if selection is None:
+        return corpus
+    if isinstance(selection, str):
+        selection = [selection]
+    return corpus + '_' + '_'.join(selection)
+
+
+def brown(categories=None, cache_dir=DEFAULT_CACHE_DIR):
+    ''' The tagged sentences of some categories (all if None) of the Brown corpus, as brown.tagged_sents() '''
+    from nltk.corpus import brown as brown_corpus
+    return cached(_name('brown', categories),
+                  lambda: CorpusSnapshot.build(brown_corpus.tagged_sents(categories=categories), tagged=True),
+                  cache_dir)
+
+
+def treebank(cache_dir=DEFAULT_CACHE_DIR):
+    ''' The parsed sentences of the Penn treebank (sample), as treebank.parsed_sents() '''
+    from nltk.corpus import treebank as treebank_corpus
+    return cached('treebank', lambda: CorpusSnapshot.build(treebank_corpus.parsed_sents(), parsed=True), cache_dir)
+
+
+def gutenberg(fileids=None, cache_dir=DEFAULT_CACHE_DIR):
+    ''' The words of some files (all if None) of the Gutenberg corpus, as gutenberg.words(): one "sentence" per file '''
+    from nltk.corpus import gutenberg as gutenberg_corpus
+    if isinstance(fileids, str):
+        fileids = [fileids]
+    name = _name('gutenberg', None if fileids is None else [fileid.replace('.txt', '') for fileid in fileids])
+    return cached(name, lambda: CorpusSnapshot.build(gutenberg_corpus.words(fileid)
+                                                     for fileid in (fileids or gutenberg_corpus.fileids())), cache_dir)
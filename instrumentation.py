@@ -0,0 +1,163 @@
+'''
+Opt-in instrumentation of the hot paths of the HMM tagger and of the PCFG parser: timers, counters,
+a trace file (one JSON line for each timed call) and cProfile.
+It is off by default: when off, a timer or a counter costs a call and a test. E.g.:
+    import instrumentation
+    instrumentation.enable(trace_path='trace.jsonl', profile=True)
+    ...                                           # tag or parse
+    instrumentation.finish('profile.pstats')      # then: python -m pstats profile.pstats
+The slowest sentences are the trace lines with the largest 'duration', e.g. of the timer 'tagger.decode'
+'''
+
+import json
+import time
+import cProfile
+import pstats
+import functools
+from collections import Counter
+
+_enabled = False
+_timers = {}             # name --> [calls, total seconds, max seconds]
+_counters = Counter()    # name --> count
+_trace_file = None
+_profiler = None
+_origin = time.perf_counter()   # trace times are relative to it
+
+
+def enabled():
+    return _enabled
+
+
+def enable(trace_path=None, profile=False):
+    ''' Starts collecting timers and counters; timed calls are appended to trace_path, if given; profile: run cProfile '''
+    global _enabled, _trace_file, _profiler
+    disable()
+    if trace_path is not None:
+        _trace_file = open(trace_path, 'a')
+    if profile:
+        if _profiler is None:
+            _profiler = cProfile.Profile()
+        _profiler.enable()
+    _enabled = True
+
+
+def disable():
+    ''' Stops collecting (what has been collected is kept, see reset()) '''
+    global _enabled, _trace_file
+    _enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+    if _trace_file is not None:
+        _trace_file.close()
+        _trace_file = None
+
+
+def reset():
+    ''' Forgets timers, counters and profile '''
+    global _profiler
+    _timers.clear()
+    _counters.clear()
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler = None
+
+
+class _Timer:
+    __slots__ = ('name', 'attributes', 'start')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        stats = _timers.get(self.name)
+        if stats is None:
+            stats = _timers[self.name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        if _trace_file is not None:
+            event = {'name': self.name, 'start': self.start - _origin, 'duration': duration}
+            event.update(self.attributes)
+            _trace_file.write(json.dumps(event) + '\n')
+        return False
+
+
+class _NullTimer:
+    ''' The timer used when instrumentation is off: does nothing '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name, **attributes):
+    '''
+    Context manager: times the block, and adds its duration to the timer called name;
+    the attributes (e.g., the length of a sentence) are written to the trace, with the duration
+    '''
+    return _Timer(name, attributes) if _enabled else _NULL_TIMER
+
+
+def count(name, n=1):
+    if _enabled:
+        _counters[name] += n
+
+
+def instrumented(name):
+    ''' Decorator: times each call of the function with the timer called name '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timers():
+    ''' {name: (calls, total seconds, max seconds)} '''
+    return {name: tuple(stats) for name, stats in _timers.items()}
+
+
+def counters():
+    return dict(_counters)
+
+
+def report(n_functions=0):
+    ''' Prints the timers and the counters; and the n_functions slowest functions of the profile (cumulative time) '''
+    print("%-40s %10s %12s %12s %12s" % ("timer", "calls", "total (s)", "mean (ms)", "max (ms)"))
+    for name, (calls, total, longest) in sorted(_timers.items(), key=lambda item: -item[1][1]):
+        print("%-40s %10d %12.3f %12.3f %12.3f" % (name, calls, total, total / calls * 1000, longest * 1000))
+    for name, value in sorted(_counters.items()):
+        print("%-40s %10d" % (name, value))
+    if n_functions and _profiler is not None:
+        pstats.Stats(_profiler).sort_stats('cumulative').print_stats(n_functions)
+
+
+def dump_stats(stats_path):
+    ''' Saves the profile in the pstats format '''
+    if _profiler is None:
+        raise ValueError("profiling was not enabled")
+    _profiler.dump_stats(stats_path)
+
+
+def finish(stats_path=None):
+    ''' Stops collecting, prints the report, and saves the profile (if any) to stats_path '''
+    disable()
+    report()
+    if stats_path is not None and _profiler is not None:
+        dump_stats(stats_path)
@@ -23,6 +23,16 @@ from nltk.classify.util import accuracy
 from nltk import WordNetLemmatizer
 from nltk.probability import FreqDist  # this is useful, somewhere...
 import random
+import os
+import sys
+import math
+import time
+import pickle
+import statistics
+from multiprocessing import Pool
+from collections import deque
+from functools import lru_cache
+import numpy as np
 
 
 def extract_context(list_of_lemmas, idx, context_limit):
@@ -38,22 +48,11 @@ def extract_context(list_of_lemmas, idx, context_limit):
 		 - the list of lemmas, with length context_limit, after idx;
 		   complete with '' if no enough lemmas are available after idx
 	'''
-	# COMPLETE HERE
 	# NB: adds '' to fill left and right contexts, if they are close to the beginning or the end of the text
-	if (idx - context_limit) >= 0:
-		left_context = list_of_lemmas[idx-context_limit:idx]
-
-	else :
-		if i <= context_limit - idx :
-			num_zero[ i ] += [ ' ' ]
-		left_context = num_zero[ i ] + [ x[ 0 : idx - 1 ] for x in list_of_lemmas]
-
-	if ((len( list_of_lemmas ) - idx) - context_limit) >= 0 :
-		right_context = [ x[ idx - 1 : idx + context_limit ] for x in list_of_lemmas ]
-	else :
-		if i <= context_limit - (len( list_of_lemmas ) - idx) :
-			num_zero[ i ] += [ ' ' ]
-		right_context = [ x[ idx - 1 : end ] for x in list_of_lemmas ] + num_zero[ i ]
+	left_context = list_of_lemmas[max(0, idx - context_limit):idx]
+	left_context = [''] * (context_limit - len(left_context)) + left_context
+	right_context = list_of_lemmas[idx + 1:idx + 1 + context_limit]
+	right_context = right_context + [''] * (context_limit - len(right_context))
 
 	return left_context, right_context
 	# E.g. ['jenn_barthole']   and   ['survey']
@@ -67,21 +66,88 @@ def get_best_co_occurring_lemmas(target_lemma, n, context_limit, texts):
 	- context_limit: how many lemmas to consider, before and after the target lemma
 	- texts: the corpus; an hashtable where items are file names;
 		     e.g.: {'COMPANY': './data/apple-company-training.txt', 'FRUIT': './data/apple-fruit-training.txt'}
+		     or a LemmaIndex of the corpus, to avoid lemmatizing it again
 	- returns: a list of the n most co-occurring lemmas
 	'''
-	
-	# COMPLETE HERE
-	# - Accumulate all the co-occurring lemmas within the specified context limit
-	# - Get the n most frequent co-occurring lemmas
-	text = open(texts, 'r', encoding='utf-8').read()
-	fdist = max(FreqDist(text))[:n]
-	co_occurrences[0:n] = [w for w in text if FreqDist(w) == fdist]
+	index = texts if isinstance(texts, LemmaIndex) else LemmaIndex.from_files(texts)
+	return index.best_co_occurring_lemmas(target_lemma, n, context_limit)
+	# e.g., ['crisp', 'http', 'ipad', 'iphone', 'juice', 'like', 'mac', 'make', 'making', 'pie', 'product', 'sauce']
+
 
+class LemmaIndex:
+	'''
+	Positional index of lemmatized documents (e.g., the training file of each sense), built once and reused:
+	- documents: {name: list of pairs (lemma, word)}
+	- positions: {name: {lemma: list of the positions of lemma in the document}}
+	- sources: {name: (file name, modification time)}, to know whether the index is still up to date
+	'''
+	def __init__(self):
+		self.documents = {}
+		self.positions = {}
+		self.sources = {}
 
+	@classmethod
+	def from_files(cls, texts):
+		''' Builds the index of the files; texts: {name: file name} '''
+		index = cls()
+		for name, file_name in texts.items():
+			with open(file_name, 'r', encoding='utf-8') as text_file:
+				index.add_document(name, add_lemmas(text_file.read()))
+			index.sources[name] = (file_name, os.path.getmtime(file_name))
+		return index
 
+	@classmethod
+	def cached(cls, texts, index_path):
+		''' Loads the index of the files from index_path, or builds it (and saves it) if missing or out of date '''
+		if os.path.exists(index_path):
+			index = cls.load(index_path)
+			if index.sources == {name: (file_name, os.path.getmtime(file_name)) for name, file_name in texts.items()}:
+				return index
+		index = cls.from_files(texts)
+		index.save(index_path)
+		return index
 
-   	return co_occurrences[:n]    # The first n lemmas
-	# e.g., ['crisp', 'http', 'ipad', 'iphone', 'juice', 'like', 'mac', 'make', 'making', 'pie', 'product', 'sauce']
+	def add_document(self, name, list_of_lemmas_words):
+		self.documents[name] = list_of_lemmas_words
+		positions = {}
+		for idx, (lemma, word) in enumerate(list_of_lemmas_words):
+			positions.setdefault(lemma, []).append(idx)
+		self.positions[name] = positions
+
+	def lemmas(self, name):
+		''' The list of lemmas of a document '''
+		return [lemma for (lemma, word) in self.documents[name]]
+
+	def occurrences(self, name, target_lemma, context_limit):
+		'''
+		Generator: for each occurrence of target_lemma in the document, yields (idx, word, left context, right context);
+		contexts are lists of context_limit lemmas, as extract_context() returns them
+		'''
+		list_of_lemmas = self.lemmas(name)
+		for idx in self.positions[name].get(target_lemma, []):
+			left_context, right_context = extract_context(list_of_lemmas, idx, context_limit)
+			yield idx, self.documents[name][idx][1], left_context, right_context
+
+	def best_co_occurring_lemmas(self, target_lemma, n, context_limit):
+		''' The n lemmas that occur most frequently within context_limit lemmas of target_lemma, in all the documents '''
+		fdist = FreqDist()
+		for name, list_of_lemmas_words in self.documents.items():
+			for idx in self.positions[name].get(target_lemma, []):
+				for lemma, word in list_of_lemmas_words[max(0, idx - context_limit):idx + context_limit + 1]:
+					if lemma != target_lemma:
+						fdist[lemma] += 1
+		return sorted(lemma for (lemma, count) in fdist.most_common(n))
+
+	def save(self, index_path):
+		with open(index_path, 'wb') as index_file:
+			pickle.dump(self.__dict__, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+	@classmethod
+	def load(cls, index_path):
+		index = cls()
+		with open(index_path, 'rb') as index_file:
+			index.__dict__.update(pickle.load(index_file))
+		return index
 
 
 def features(target_word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas):
@@ -95,14 +161,163 @@ def features(target_word, left_context_lemmas, right_context_lemmas, best_co_occ
 	- returns: an hashtable {'word': ..., 'left_collocations': ..., 'right_collocations': ..., 'co_occurrence': ...}
 	'''
 
-	# COMPLETE HERE
-	# - Build co-occurrence vector, e.g. [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0]
-	# - returns the dictionary; notice that list are mutable and cannot be used in a dict; you need to convert them to tuples
+	# Build co-occurrence vector, e.g. [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0]: 1 if the lemma is in the context
+	context_lemmas = set(left_context_lemmas) | set(right_context_lemmas)
+	co_occurrence = [1 if lemma in context_lemmas else 0 for lemma in best_co_occurring_lemmas]
 
-	return {'word': ..., 'left_collocations':..., 'right_collocations': ..., 'co_occurrence': ...}
+	# notice that list are mutable and cannot be used in a dict; they are converted to tuples
+	return {'word': target_word, 'left_collocations': tuple(left_context_lemmas),
+	        'right_collocations': tuple(right_context_lemmas), 'co_occurrence': tuple(co_occurrence)}
 	# e.g.: {'word': 'apples', 'left_collocations': ('jenn_barthole'), 'right_collocations': ('survey'),
 	#	     'co_occurrence': (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0), 'word': 'apples'}
 
+
+class FeatureEncoder:
+	'''
+	Encodes featuresets as integer arrays: each (feature name, feature value) pair seen in training gets an index,
+	and a featureset becomes the array of the indexes of its values, one for each feature name.
+	As in NLTK, a feature missing from a training featureset has value None
+	'''
+	def __init__(self):
+		self.fnames = []			# feature names, in order
+		self.value_index = {}		# (fname, fval) --> index
+		self.value_fname = []		# index --> position of the feature name in self.fnames
+
+	def fit(self, featuresets):
+		for featureset in featuresets:
+			for fname in featureset:
+				if fname not in self.fnames:
+					self.fnames.append(fname)
+		for featureset in featuresets:
+			for f, fname in enumerate(self.fnames):
+				key = (fname, featureset.get(fname))
+				if key not in self.value_index:
+					self.value_index[key] = len(self.value_fname)
+					self.value_fname.append(f)
+		return self
+
+	def transform(self, featuresets, unseen=-1, missing=-2):
+		'''
+		Returns an array (featuresets x feature names) of value indexes;
+		values never seen in training are encoded as 'unseen', missing features as 'missing'
+		'''
+		encoded = np.empty((len(featuresets), len(self.fnames)), dtype=np.intp)
+		for i, featureset in enumerate(featuresets):
+			for f, fname in enumerate(self.fnames):
+				if fname in featureset:
+					encoded[i, f] = self.value_index.get((fname, featureset[fname]), unseen)
+				else:
+					encoded[i, f] = missing
+		return encoded
+
+
+class NumpyNaiveBayesClassifier:
+	'''
+	A Naive Bayes classifier equivalent to NLTK NaiveBayesClassifier (same ELE smoothing, same decisions), but
+	featuresets are encoded with a FeatureEncoder, and many featuresets are classified at once with NumPy.
+	Each feature is categorical: its one-hot encoding is a multinomial with exactly one draw per featureset
+	'''
+	def __init__(self, labels, encoder, label_logprob, value_logprob):
+		self._labels = labels
+		self._encoder = encoder
+		self._label_logprob = label_logprob		# labels
+		self._value_logprob = value_logprob		# labels x (values + unseen value of each feature + missing feature)
+		# labels sorted in reverse order: in case of a tie NLTK chooses the greatest label
+		self._tie_order = np.array(sorted(range(len(labels)), key=lambda l: labels[l], reverse=True), dtype=np.intp)
+
+	@classmethod
+	def train(cls, labeled_featuresets, gamma=0.5):
+		''' gamma=0.5: ELE smoothing, the NLTK default '''
+		featuresets = [featureset for (featureset, label) in labeled_featuresets]
+		encoder = FeatureEncoder().fit(featuresets)
+		labels = list(FreqDist(label for (featureset, label) in labeled_featuresets))  # in order of appearance
+		label_ids = np.array([labels.index(label) for (featureset, label) in labeled_featuresets], dtype=np.intp)
+		# missing features have value None (see FeatureEncoder.fit())
+		encoded = encoder.transform([{fname: featureset.get(fname) for fname in encoder.fnames} for featureset in featuresets])
+		n_labels, n_values, n_fnames = len(labels), len(encoder.value_fname), len(encoder.fnames)
+
+		# counts[label, value] in one call: each (label, value) pair gets its own bin
+		counts = np.bincount((label_ids[:, np.newaxis] * n_values + encoded).ravel(), minlength=n_labels * n_values)
+		counts = counts.reshape(n_labels, n_values)
+		label_counts = np.bincount(label_ids, minlength=n_labels)
+		n_fvalues = np.bincount(encoder.value_fname, minlength=n_fnames)	# how many values for each feature
+
+		# log-probabilities, computed exactly as LidstoneProbDist does, for the same results
+		n_samples = len(label_ids)
+		label_logprob = np.array([math.log((label_counts[l] + gamma) / (n_samples + n_labels * gamma), 2)
+		                          for l in range(n_labels)])
+		value_logprob = np.zeros((n_labels, n_values + n_fnames + 1))
+		for l in range(n_labels):
+			for v, f in enumerate(encoder.value_fname):
+				value_logprob[l, v] = math.log((counts[l, v] + gamma) / (label_counts[l] + n_fvalues[f] * gamma), 2)
+			for f in range(n_fnames):
+				value_logprob[l, n_values + f] = math.log(gamma / (label_counts[l] + n_fvalues[f] * gamma), 2)
+		# the last column (a missing feature) stays 0: it does not change the probability
+		return cls(labels, encoder, label_logprob, value_logprob)
+
+	def labels(self):
+		return self._labels
+
+	def log_scores(self, featuresets):
+		''' Array (featuresets x labels) of the log-probabilities (base 2, not normalized) of each label '''
+		n_values = len(self._encoder.value_fname)
+		unseen_columns = n_values + np.arange(len(self._encoder.fnames))
+		encoded = self._encoder.transform(featuresets, unseen=-1, missing=-2)
+		encoded = np.where(encoded == -1, unseen_columns, encoded)
+		encoded[encoded == -2] = self._value_logprob.shape[1] - 1
+		scores = np.tile(self._label_logprob, (len(featuresets), 1))
+		# same order of the sums of NLTK (that follows the order of the features in each featureset, as features() builds them)
+		for f in range(encoded.shape[1]):
+			scores += self._value_logprob[:, encoded[:, f]].T
+		return scores
+
+	def classify_many(self, featuresets):
+		if not featuresets:
+			return []
+		best = self.log_scores(featuresets)[:, self._tie_order].argmax(axis=1)
+		return [self._labels[l] for l in self._tie_order[best]]
+
+	def classify(self, featureset):
+		return self.classify_many([featureset])[0]
+
+
+class LemmatizingPipeline:
+	'''
+	Tokenizes and lemmatizes texts, with WordNet; the tokenizer, the lemmatizer and the stopwords are loaded only once,
+	and the lemmas of the most recent (at most cache_size) words are cached, as the same words occur again and again
+	'''
+	def __init__(self, cache_size=50000):
+		self.tokenizer = WordPunctTokenizer()
+		self.stopwords = frozenset(stopwords.words('english'))	# a set: fast lookup
+		self.lemmatize = lru_cache(maxsize=cache_size)(WordNetLemmatizer().lemmatize)
+
+	def add_lemmas(self, text):
+		'''
+		Lemmatizes the text; returns (lemma, word) for each word in text
+		NB: discards stopwords and tokens of 1 character
+		'''
+		tokens = self.tokenizer.tokenize(text) # notice that the tokenizer splits words like '#apple' into '#', 'apple'
+		result = []
+		for x in tokens:
+			if x not in self.stopwords and len(x) > 1:
+				word = x.lower()
+				result.append((self.lemmatize(word), word))
+		return result # the pairs (lemma, word)
+
+	def add_lemmas_batch(self, texts):
+		''' Lemmatizes many texts; returns a list of pairs (lemma, word) for each text '''
+		return [self.add_lemmas(text) for text in texts]
+
+	def cache_hit_rate(self):
+		''' Fraction of the words whose lemma was found in the cache '''
+		info = self.lemmatize.cache_info()
+		lookups = info.hits + info.misses
+		return info.hits / lookups if lookups else 0.0
+
+
+_lemmatizing_pipeline = None	# created when needed, then shared by all the calls of add_lemmas()
+
+
 def add_lemmas(text):
 	'''	
 	Lemmatizes the text, using WordNet; returns (lemma, word) for each word in text
@@ -110,11 +325,145 @@ def add_lemmas(text):
 	- text: list of tokens of the document to lemmatize
 	- returns: a list of pairs (lemma, word)
 	'''
-	tokenizer = WordPunctTokenizer()
-	tokens = tokenizer.tokenize(text) # notice that the tokenizer splits words like '#apple' into '#', 'apple'		
-	lem = WordNetLemmatizer()
-	result =  [(lem.lemmatize(x.lower()),x.lower()) for x in tokens	if x not in stopwords.words('english') and len(x) > 1]
-	return result # the pairs (lemma, word) 
+	global _lemmatizing_pipeline
+	if _lemmatizing_pipeline is None:
+		_lemmatizing_pipeline = LemmatizingPipeline()
+	return _lemmatizing_pipeline.add_lemmas(text)
+
+
+def lemma_cache_hit_rate():
+	''' Fraction of the words lemmatized by add_lemmas() whose lemma was found in the cache (0 if none was) '''
+	if _lemmatizing_pipeline is None:
+		return 0.0
+	return _lemmatizing_pipeline.cache_hit_rate()
+
+
+def stratified_folds(labels, k, seed):
+	'''
+	Splits the indexes of the samples into k folds, each one with (about) the same proportion of each label;
+	the same seed always gives the same folds. Returns k lists of indexes (the test set of each fold)
+	'''
+	rnd = random.Random(seed)
+	folds = [[] for fold in range(k)]
+	next_fold = 0
+	for label in sorted(set(labels)):
+		indexes = [i for i, sample_label in enumerate(labels) if sample_label == label]
+		rnd.shuffle(indexes)
+		for i in indexes:	# deal the samples of each label in turn, as cards
+			folds[next_fold].append(i)
+			next_fold = (next_fold + 1) % k
+	return folds
+
+
+def random_subsamples(n_samples, repetitions, test_fraction, seed):
+	''' Repeated random subsampling: returns the test set indexes of each repetition '''
+	rnd = random.Random(seed)
+	test_size = int(round(test_fraction * n_samples))
+	return [rnd.sample(range(n_samples), test_size) for repetition in range(repetitions)]
+
+
+# featuresets shared by the processes of cross_validate(), set once in each worker by _init_validation_worker()
+_validation_featuresets = None
+_validation_classifier_class = None
+
+
+def _init_validation_worker(labeled_featuresets, classifier_class):
+	global _validation_featuresets, _validation_classifier_class
+	_validation_featuresets = labeled_featuresets
+	_validation_classifier_class = classifier_class
+
+
+def _validate_fold(test_indexes):
+	''' Worker process: trains on all the samples but test_indexes, tests on them; returns (accuracy, seconds) '''
+	start = time.perf_counter()
+	test_indexes = set(test_indexes)
+	train_set = [sample for i, sample in enumerate(_validation_featuresets) if i not in test_indexes]
+	test_set = [sample for i, sample in enumerate(_validation_featuresets) if i in test_indexes]
+	classifier = _validation_classifier_class.train(train_set)
+	return accuracy(classifier, test_set), time.perf_counter() - start
+
+
+def cross_validate(labeled_featuresets, test_splits, classifier_class=NumpyNaiveBayesClassifier, processes=None):
+	'''
+	Trains and tests a classifier for each split (the list of test indexes; all the other samples are used for training),
+	in parallel; the featuresets are computed once and shared by all the processes.
+	Prints accuracy and time of each split, average accuracy and standard deviation; returns the accuracies
+	'''
+	with Pool(processes, initializer=_init_validation_worker, initargs=(labeled_featuresets, classifier_class)) as pool:
+		results = pool.map(_validate_fold, test_splits)
+	for split, (split_accuracy, seconds) in enumerate(results):
+		print("  #%d: accuracy %.4f (%.3f s)" % (split, split_accuracy, seconds))
+	accuracies = [split_accuracy for (split_accuracy, seconds) in results]
+	print("  Average accuracy: %.4f, standard deviation: %.4f" %
+	      (statistics.mean(accuracies), statistics.stdev(accuracies) if len(accuracies) > 1 else 0.0))
+	return accuracies
+
+
+def read_tweets(source):
+	''' Generator: yields the tweets (one for each line) of a file, or of the standard input if source is '-' '''
+	stream = sys.stdin if source == '-' else open(source, 'r', encoding='utf-8')
+	try:
+		for line in stream:
+			line = line.strip()
+			if line:
+				yield line
+	finally:
+		if stream is not sys.stdin:
+			stream.close()
+
+
+def lemmatize_tweets(tweets):
+	''' Generator: yields the list of pairs (lemma, word) of each tweet '''
+	for tweet in tweets:
+		yield add_lemmas(tweet)
+
+
+def target_windows(lemmatized_tweets, target_lemma, context_limit, surrounding=10):
+	'''
+	Generator: for each occurrence of target_lemma, yields (word, left context lemmas, right context lemmas,
+	left surrounding words, right surrounding words); each tweet is a context on its own.
+	Surrounding words are the words of add_lemmas(): stopwords and tokens of 1 character are not included
+	(stopwords are matched before lower-casing, so a capitalized 'For' is kept, while 'for' is not).
+	The (at most) surrounding words before the target come from a ring buffer of the last words;
+	the ones after the target are collected while the next words arrive
+	'''
+	for list_of_lemmas_words in lemmatized_tweets:
+		list_of_lemmas = [lemma for (lemma, word) in list_of_lemmas_words]
+		last_words = deque(maxlen=surrounding)	# the ring buffer
+		waiting = deque()	# occurrences still collecting their right surrounding words
+		for idx, (lemma, word) in enumerate(list_of_lemmas_words):
+			for occurrence in waiting:
+				occurrence[-1].append(word)
+			while waiting and len(waiting[0][-1]) == surrounding:
+				yield tuple(waiting.popleft())
+			if lemma == target_lemma:
+				left_context_lemmas, right_context_lemmas = extract_context(list_of_lemmas, idx, context_limit)
+				waiting.append([word, left_context_lemmas, right_context_lemmas, list(last_words), []])
+			last_words.append(word)
+		while waiting:	# the tweet is over
+			yield tuple(waiting.popleft())
+
+
+def classify_windows(windows, classifier, best_co_occurring_lemmas, batch_size=1):
+	'''
+	Generator: classifies the windows of target_windows(), batch_size at a time;
+	yields (decision, word, left surrounding words, right surrounding words)
+	'''
+	batch = []
+	for window in windows:
+		batch.append(window)
+		if len(batch) == batch_size:
+			yield from _classify_batch(batch, classifier, best_co_occurring_lemmas)
+			batch = []
+	yield from _classify_batch(batch, classifier, best_co_occurring_lemmas)
+
+
+def _classify_batch(batch, classifier, best_co_occurring_lemmas):
+	featuresets = [features(word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas)
+	               for (word, left_context_lemmas, right_context_lemmas, left_surrounding, right_surrounding) in batch]
+	for decision, (word, left_context_lemmas, right_context_lemmas, left_surrounding, right_surrounding) in \
+			zip(classifier.classify_many(featuresets), batch):
+		yield decision, word, left_surrounding, right_surrounding
 
 
 def main():
@@ -122,66 +471,74 @@ def main():
 	train_test_texts = {}  # a void hash table
 	train_test_texts['FRUIT'] = './data/apple-fruit-training.txt'
 	train_test_texts['COMPANY'] = './data/apple-company-training.txt'
-	experiment_text = './data/apple-tweets.txt'
+	experiment_text = sys.argv[1] if len(sys.argv) > 1 else './data/apple-tweets.txt'	# '-': the standard input
+	index_path = './data/apple-training.index'	# the lemmatized training files, indexed
 	lemma_to_classify = 'apple'   # Give it in its base form, so 'apple' and 'apples' are both classified
 	context_limit = 1   # Context will be +/- 1
 	n_for_co_occurring = 12 # How many co-occurring lemmas to retain; e.g. retain the 12 best co-occurring lemmas
 	train_set_fraction = 0.8  # 80 %
+	k = 10	# folds for the cross-validation
+	seed = 1	# the same seed, the same splits (and results) at each run
+
+	# Lemmatize and index the training files once (the index is saved, and reused until the files change)
+	index = LemmaIndex.cached(train_test_texts, index_path)
 
 	# Build vector of the best co-occurring lemmas, for all the meaning of the lemma to classify
 	best_co_occurring_lemmas = get_best_co_occurring_lemmas(lemma_to_classify, n_for_co_occurring, \
-	                                                        context_limit, train_test_texts)
+	                                                        context_limit, index)
 
-	# Loop through each item, grab the text, tokenize it and create a training feature with it
+	# Loop through each occurrence of the lemma in each training file, and create a training feature with it
 	featuresets = []
-	for sense, training_file in iter(train_test_texts.items()):  # iter() creates couples (index, item); index is a string here
+	for sense in train_test_texts:
 		print("Training %s..." % sense)
-		text = open(training_file, 'r', encoding='utf-8').read()		
-		list_of_lemmas_words = add_lemmas(text)
-		list_of_lemmas = [x[0] for x in list_of_lemmas_words]	# Retains only lemmas
-		for idx, (lemma,word) in enumerate(list_of_lemmas_words): # After enumerate():[(1,('cats','cat')),(2,('dog','dog')),...]
-			if lemma == lemma_to_classify:
-				left_context_lemmas, right_context_lemmas = extract_context(list_of_lemmas, idx, context_limit)		
-				# Append a new tuple to the list
-				# Notice we use word, not lemma as a feature
-				featuresets += [(features(word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas), sense)]
-
-		# COMPLETE HERE: print how many samples of lemma_to_classify, for the current sense
+		n_samples = 0
+		for idx, word, left_context_lemmas, right_context_lemmas in index.occurrences(sense, lemma_to_classify, context_limit):
+			# Append a new tuple to the list
+			# Notice we use word, not lemma as a feature
+			featuresets += [(features(word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas), sense)]
+			n_samples += 1
+
+		print("%d samples of '%s' for %s" % (n_samples, lemma_to_classify, sense))
 
 	# Select training set and test set
 	# Shuffling is needed so that train_set and test_set will contain samples from both the first and the second file
-	random.shuffle(featuresets)	 
+	random.Random(seed).shuffle(featuresets)	 
 	train_set_limit = int(train_set_fraction * len(featuresets))				
 	train_set, test_set = featuresets[:train_set_limit], featuresets[train_set_limit:]
 	
 	# Train...
 	classifier = NaiveBayesClassifier.train(train_set)
+	numpy_classifier = NumpyNaiveBayesClassifier.train(train_set)	# the same classifier, but faster
 	
-	# Test... Notice that each run will result in a different accuracy, as the train set is randomly chosen
+	# Test... Notice that a different seed will result in a different accuracy, as the train set is randomly chosen
 	print("Accuracy:", accuracy(classifier, test_set))
+	test_featuresets = [featureset for (featureset, sense) in test_set]
+	disagreements = sum(1 for (decision1, decision2) in zip(classifier.classify_many(test_featuresets),
+	                                                        numpy_classifier.classify_many(test_featuresets))
+	                    if decision1 != decision2)
+	print("NumPy classifier: accuracy %s, %d different decisions" % (accuracy(numpy_classifier, test_set), disagreements))
 	
-	# Try to classify a new file and print the surrounding words of the classified lemma
+	# K-fold and random sampling validation: average accuracy and standard deviation
+	print("\n%d-fold cross-validation:" % k)
+	cross_validate(featuresets, stratified_folds([sense for (featureset, sense) in featuresets], k, seed))
+	print("Repeated random subsampling (%d times):" % k)
+	cross_validate(featuresets, random_subsamples(len(featuresets), k, 1 - train_set_fraction, seed))
+
+	# Try to classify a new file (or the standard input), one tweet at a time, and print the surrounding words
+	# of the classified lemma; memory does not grow with the size of the file
 	print("\nClassify new text: %s" % experiment_text)
-	text = open(experiment_text, 'r', encoding='utf-8').read()
-	list_of_lemmas_words = add_lemmas(text)
-	list_of_lemmas = [x[0] for x in list_of_lemmas_words]	# Retains only lemmas of the current text
-	for idx, (lemma,word) in enumerate(list_of_lemmas_words):   # After enumerate(): [(1,('cat','cats')),(2,('dog','dog')), ...]
-		if lemma == lemma_to_classify:
-			left_context_lemmas, right_context_lemmas = extract_context(list_of_lemmas, idx, context_limit)	
-			decision = classifier.classify(features(word, left_context_lemmas, right_context_lemmas, best_co_occurring_lemmas))
-
-			# COMPLETE HERE
-			# - Extract at most 10 tokens before the target lemma
-			# - Extract at most 10 tokens after the target lemma
-			print("Class: %s\tWhere(+-10): %s *%s* %s" % (decision, left_surrounding, lemma, right_surrounding))
-			# E.g.: Class: COMPANY	Where(+-10): ['noosy', 'offers', 'hdmi', 'adapter', 'for', 'the', 'ipad', 'iphone',
-		    #       'ipod', 'touch'] *apple* ['ipad', 'iphone', 'http', '://', 'bit', 'ly']
-
-	# COMPLETE HERE
-	# K-fold or random sampling validation
-	# calculate:
-	#   - average accuracy
-	#   - standard deviation
+	tweets = lemmatize_tweets(read_tweets(experiment_text))
+	windows = target_windows(tweets, lemma_to_classify, context_limit)
+	batch_size = 1 if experiment_text == '-' else 64	# the standard input: answer as soon as possible
+	for decision, word, left_surrounding, right_surrounding in classify_windows(windows, numpy_classifier,
+	                                                                           best_co_occurring_lemmas, batch_size):
+		print("Class: %s\tWhere(+-10): %s *%s* %s" % (decision, left_surrounding, lemma_to_classify, right_surrounding))
+		# E.g., for 'NOOSY Offers HDMI Adapter For The iPad, iPhone 4 and iPod touch #it #apple #ipad #iphone
+		# http://bit.ly/aVf6J9' ('4', 'and', 'it', '#', ',', '.', '/' are dropped by add_lemmas(), 'For', 'The' are not):
+		#       Class: COMPANY	Where(+-10): ['noosy', 'offers', 'hdmi', 'adapter', 'for', 'the', 'ipad', 'iphone',
+		#       'ipod', 'touch'] *apple* ['ipad', 'iphone', 'http', '://', 'bit', 'ly', 'avf6j9']
+
+	print("Lemma cache hit rate: %.1f%%" % (lemma_cache_hit_rate() * 100))
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,40 @@
+'''
+Tests of the unknown word model of the HMM tagger, on a tiny train set (no corpus is needed). Run with:
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import importlib
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+tagger = importlib.import_module('4_HMM_POS_tagger')
+
+TRAIN_SET = [[('the', 'AT'), ('dog', 'NN'), ('runs', 'VBZ')],
+             [('the', 'AT'), ('cat', 'NN'), ('sleeps', 'VBZ')],
+             [('a', 'AT'), ('dog', 'NN'), ('sleeps', 'VBZ')]]
+
+
+class UnknownWordModelTest(unittest.TestCase):
+    def setUp(self):
+        words = {word for tagged_sentence in TRAIN_SET for (word, tag) in tagged_sentence}
+        hmm = tagger.train(TRAIN_SET, words, {'AT', 'NN', 'VBZ'}, estimator=tagger.lidstone)
+        self.tables = tagger.compile_tables(hmm)
+
+    def test_no_rare_words(self):
+        # rare_threshold=0: no word is rare, the model has only the empty suffix and all tags are equally likely
+        tables = self.tables._replace(**tagger.train_unknown_words(TRAIN_SET, self.tables.tags, rare_threshold=0))
+        self.assertEqual(tables.suffix_index, {'': 0})
+        np.testing.assert_array_equal(tagger.unknown_word_emission(tables, 'horse'), np.zeros(3))
+        self.assertEqual(tagger.viterbi_batch(tables, [['the', 'horse', 'runs']]), [['AT', 'NN', 'VBZ']])
+
+    def test_rare_words(self):
+        tables = self.tables._replace(**tagger.train_unknown_words(TRAIN_SET, self.tables.tags, rare_threshold=1))
+        self.assertIn('', tables.suffix_index)
+        self.assertEqual(tagger.viterbi_batch(tables, [['a', 'horse', 'runs']]), [['AT', 'NN', 'VBZ']])
+
+
+if __name__ == '__main__':
+    unittest.main()